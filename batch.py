@@ -0,0 +1,194 @@
+"""Transcribes and scores many videos across a process pool, as for a nightly regression run.
+
+Usage: python batch.py [VIDEOS] [--processes N] [--ground-truths DIR] [--json PATH] [transcription options]
+e.g. python batch.py data --processes 4 --json output/batch.json
+
+VIDEOS is a directory, whose .mp4 files are all transcribed (./data by default), or a manifest file
+listing one video per line, as a path or the name of a video in ./data (blank lines and lines
+starting with # are skipped). Each video is calibrated on <video>-f00.png beside it if there is one,
+otherwise on its first frame. Videos are handed to the pool largest first, so that the longest
+aren't left running alone at the end. Each finished transcription's log is written to
+./output/<name>.log and scored in memory against ./ground_truths/<name>, if there is one. The report
+gives each video's precision, recall, F1, frame rate and time, and the totals over all of them.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+
+from calc_accuracy import score_lines, stats_of
+from piano_vision.events import SnapshotLogSink
+from piano_vision.main import PianoVision
+from piano_vision.processors import PressedKeyDetector
+
+
+def videos_in(source):
+	"""Video files named by source: a directory's .mp4 files, or the videos listed in a manifest."""
+	source = Path(source)
+	if source.is_dir():
+		return sorted(source.glob('*.mp4'))
+	videos = []
+	with open(source) as manifest:
+		for line in manifest:
+			line = line.strip()
+			if line and not line.startswith('#'):
+				video = Path(line)
+				videos.append(video if video.suffix else Path('data/{}.mp4'.format(line)))
+	return videos
+
+
+def single_threaded():
+	"""Worker initializer: the pool supplies the parallelism, so OpenCV shouldn't add more threads."""
+	cv2.setNumThreads(1)
+
+
+def transcribe_video(video_file, truths, options):
+	"""Worker: transcribe a video headless, returning its snapshot log lines (as many as there are
+	ground truth lines, or the usual number without a ground truth) and how long it took."""
+	start = time.perf_counter()
+	piano_vision = PianoVision(video_file.stem, headless=True, **options)
+	piano_vision.video_file = str(video_file)
+	piano_vision.ref_frame_file = str(video_file.with_name('{}-f00.png'.format(video_file.stem)))
+	limit = len(truths) if truths else PianoVision.NUM_SNAPSHOTS
+	with SnapshotLogSink(io.StringIO(), PianoVision.SNAPSHOT_INTERVAL, limit) as log:
+		events = piano_vision.transcribe(log)
+		lines = log.file.getvalue().splitlines(keepends=True)
+	return {
+		'frames': piano_vision.end_position[0],
+		'events': events,
+		'seconds': time.perf_counter() - start,
+		'lines': lines,
+	}
+
+
+def run_batch(videos, processes=None, ground_truths='ground_truths', options=None, progress=print):
+	"""Transcribe and score every video, returning the report: a result for each video, in the order
+	given, and the totals."""
+	start = time.perf_counter()
+	results = {}
+	with ProcessPoolExecutor(processes or os.cpu_count(), initializer=single_threaded) as executor:
+		futures = {}
+		for video_file in sorted(videos, key=lambda video: video.stat().st_size, reverse=True):
+			truth_file = Path(ground_truths) / video_file.stem
+			truths = truth_file.read_text().splitlines(keepends=True) if truth_file.is_file() else None
+			futures[executor.submit(transcribe_video, video_file, truths, options or {})] = video_file, truths
+
+		for future in as_completed(futures):
+			video_file, truths = futures[future]
+			result = {'name': video_file.stem, 'video': str(video_file)}
+			try:
+				transcription = future.result()
+			except Exception as e:
+				result['error'] = repr(e)
+			else:
+				lines = transcription.pop('lines')
+				Path('output').mkdir(exist_ok=True)
+				with open('output/{}.log'.format(video_file.stem), 'w') as log_file:
+					log_file.writelines(lines)
+				result.update(transcription)
+				result['fps'] = result['frames'] / result['seconds'] if result['seconds'] else 0.0
+				if truths:
+					# A video that ends early is missing its last snapshots, which count as nothing pressed
+					lines += ['{}: []\n'.format(i) for i in range(len(lines), len(truths))]
+					result.update(score_lines(truths, lines))
+			results[video_file] = result
+			if progress:
+				progress(summary_line(result))
+
+	return {'videos': [results[video_file] for video_file in videos], 'total': totals(results.values(), time.perf_counter() - start)}
+
+
+def totals(results, wall_time):
+	"""Scores over every scored video's notes together, with the frame counts and times."""
+	finished = [result for result in results if 'error' not in result]
+	scored = [result for result in finished if 'f1' in result]
+	total = {
+		'videos': len(finished),
+		'failed': sum('error' in result for result in results),
+		'scored': len(scored),
+		'frames': sum(result['frames'] for result in finished),
+		'events': sum(result['events'] for result in finished),
+		'seconds': sum(result['seconds'] for result in finished),  # spent transcribing, across all workers
+		'wall_time': wall_time,
+	}
+	total['fps'] = total['frames'] / wall_time if wall_time else 0.0
+	if scored:
+		total.update(stats_of(*(sum(result[count] for result in scored) for count in ('correct', 'false_negative', 'false_positive'))))
+	return total
+
+
+def summary_line(result):
+	if 'error' in result:
+		return '{}: failed, {}'.format(result['name'], result['error'])
+	scores = 'precision {precision:.3f}, recall {recall:.3f}, F1 {f1:.3f}, '.format(**result) if 'f1' in result else 'not scored, '
+	return '{}: {}{} frames in {:.1f}s ({:.1f} fps)'.format(result['name'], scores, result['frames'], result['seconds'], result['fps'])
+
+
+def print_report(report):
+	columns = ('video', 'precision', 'recall', 'f1', 'frames', 'fps', 'seconds')
+	rows = []
+	for result in report['videos']:
+		if 'error' in result:
+			rows.append([result['name'], 'failed', '', '', '', '', ''])
+			continue
+		scores = ['{:.3f}'.format(result[metric]) if 'f1' in result else '-' for metric in ('precision', 'recall', 'f1')]
+		rows.append([result['name'], *scores, str(result['frames']), '{:.1f}'.format(result['fps']), '{:.1f}'.format(result['seconds'])])
+	total = report['total']
+	scores = ['{:.3f}'.format(total[metric]) if total['scored'] else '-' for metric in ('precision', 'recall', 'f1')]
+	rows.append(['total', *scores, str(total['frames']), '{:.1f}'.format(total['fps']), '{:.1f}'.format(total['wall_time'])])
+
+	widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+	print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+	for row in rows:
+		print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+	print('{} videos ({} failed), total fps is over the wall time across all workers'.format(len(report['videos']), total['failed']))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('videos', nargs='?', default='data', help='directory of .mp4 files, or manifest listing videos (default: ./data)')
+	parser.add_argument('--processes', type=int, metavar='N', help='transcribe up to N videos at once (default: one per CPU)')
+	parser.add_argument('--ground-truths', default='ground_truths', metavar='DIR', help='directory of ground truths, by video name')
+	parser.add_argument('--json', metavar='PATH', help='also write the report to PATH')
+	parser.add_argument('--reuse-buffers', action='store_true', help='reuse preallocated per-frame buffers instead of allocating new ones')
+	parser.add_argument('--motion-gating', action='store_true', help='skip detection on frames where the keyboard has not changed')
+	parser.add_argument('--incremental-diff', action='store_true', help='only recompute the parts of the pressed key diff that have changed')
+	parser.add_argument('--scale', type=float, default=1.0, help='find hands and pressed keys at this fraction of the keyboard resolution')
+	parser.add_argument('--skin-lut', action='store_true', help='classify skin with a lookup table of every BGR colour instead of converting to HSV')
+	parser.add_argument('--hand-tracking', action='store_true', help='look for hands only around where they are expected, searching the whole frame when that fails')
+	parser.add_argument('--rolling-reference', type=float, nargs='?', const=PressedKeyDetector.REFERENCE_UPDATE_RATE, default=0.0, metavar='RATE', help='keep the reference frame up to date with a running average of the keys at rest, weighting each frame by RATE')
+	args = parser.parse_args()
+
+	videos = videos_in(args.videos)
+	if not videos:
+		parser.error('no videos in {}'.format(args.videos))
+	missing = [str(video_file) for video_file in videos if not video_file.is_file()]
+	if missing:
+		parser.error('no such video: {}'.format(', '.join(missing)))
+
+	options = dict(
+		reuse_buffers=args.reuse_buffers,
+		motion_gating=args.motion_gating,
+		incremental_diff=args.incremental_diff,
+		processing_scale=args.scale,
+		skin_lut=args.skin_lut,
+		rolling_reference=args.rolling_reference,
+		hand_tracking=args.hand_tracking,
+	)
+	report = run_batch(videos, args.processes, args.ground_truths, options)
+	print_report(report)
+	if args.json:
+		with open(args.json, 'w') as json_file:
+			json.dump(report, json_file, indent=2)
+	if report['total']['failed']:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,71 @@
+"""Measures memory allocated per frame by the processing pipeline, with and without buffer reuse.
+
+Usage: python benchmarks/allocations.py [video_name] [--frames N]
+Run from the repository root, so that the video is found in ./data.
+"""
+import argparse
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+
+from piano_vision.main import PianoVision
+from piano_vision.video_reader import VideoReader
+
+
+def frames_of(video_file, count):
+	with VideoReader(video_file) as video_reader:
+		for _ in range(count):
+			frame = video_reader.read_frame()
+			if frame is None:
+				return
+			yield frame
+
+
+def measure(video_name, count, reuse_buffers):
+	"""Returns the mean and max of the peak bytes allocated while processing a frame, and the mean
+	time per frame (measured separately, as tracing slows everything down). Decoding is excluded."""
+	piano_vision = PianoVision(video_name, headless=True, reuse_buffers=reuse_buffers)
+	first_frame = next(frames_of(piano_vision.video_file, 1))
+	if Path(piano_vision.ref_frame_file).exists():
+		piano_vision.handle_reference_frame(cv2.imread(piano_vision.ref_frame_file))
+	else:
+		piano_vision.handle_reference_frame(first_frame)
+
+	# Warm up, so buffers are allocated before measuring
+	piano_vision.process_frame(first_frame)
+
+	elapsed = 0
+	for frame in frames_of(piano_vision.video_file, count):
+		start = time.perf_counter()
+		piano_vision.process_frame(frame)
+		elapsed += time.perf_counter() - start
+
+	allocated = []
+	tracemalloc.start()
+	for frame in frames_of(piano_vision.video_file, count):
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		piano_vision.process_frame(frame)
+		allocated.append(tracemalloc.get_traced_memory()[1] - before)
+	tracemalloc.stop()
+
+	return sum(allocated) / len(allocated), max(allocated), elapsed / len(allocated)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('video_name', nargs='?', default='canon_in_d')
+	parser.add_argument('--frames', type=int, default=200)
+	args = parser.parse_args()
+
+	for reuse_buffers in (False, True):
+		mean, peak, per_frame = measure(args.video_name, args.frames, reuse_buffers)
+		print('reuse_buffers={!s:5}: peak allocation per frame {:8.1f} KiB on average, {:8.1f} KiB max, {:.2f} ms per frame'.format(
+			reuse_buffers, mean / 1024, peak / 1024, per_frame * 1000
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,147 @@
+"""Times HandFinder.find_fingertips against the pure Python implementation it replaced, on synthetic
+hands at 720p, 1080p and 4K, checking that both find the same fingertips.
+
+Usage: python benchmarks/fingertips.py
+"""
+import time
+from math import inf
+
+import cv2
+import numpy as np
+
+from synthetic import SyntheticVideo
+
+from piano_vision.helpers import centre_of_contour, dist
+from piano_vision.processors import HandFinder
+
+
+def group(data, radius, dist_func=dist):
+	"""Clusters data that fall within radius of each by measure of dist_func"""
+	clustered = [[data[0]]]
+	for val in data[1:]:
+		if dist_func(val, clustered[-1][0]) < radius:
+			clustered[-1].append(val)
+		else:
+			clustered.append([val])
+
+	return clustered
+
+
+def avg_of_groups(point_groups):
+	"""Given a list of groups of 2D points, returns a list with the averages
+	of each group in the same order"""
+	point_avgs = []
+
+	for group in point_groups:
+		point_avg = [[0, 0]]
+
+		for point in group:
+			point_avg[0][0] += point[0][0]
+			point_avg[0][1] += point[0][1]
+
+		point_avg[0][0] = int(round(point_avg[0][0] / len(group)))
+		point_avg[0][1] = int(round(point_avg[0][1] / len(group)))
+
+		point_avgs += [point_avg]
+
+	return point_avgs
+
+
+def index_of_closest(data, points, dist_func=dist):
+	"""Generates an index of the closest values in data to values in points by
+	measure of dist_func"""
+	ioc = []
+
+	for point in points:
+		dist_curr = float(inf)
+		indx = -1
+		for i, dpoint in enumerate(data):
+			disti = dist_func(point, dpoint)
+			if disti < dist_curr:
+				dist_curr = disti
+				indx = i
+		ioc += [indx]
+
+	return ioc
+
+
+def find_fingertips_loop(hand_finder, hand_contours):
+	"""The original implementation (less its debug drawing), kept as the reference."""
+	hands = []
+	convexity_defects = []
+
+	for contour in hand_contours:
+		convex_pts = cv2.convexHull(contour)
+		group_averages = np.array(avg_of_groups(group(convex_pts, hand_finder.max_dist)))
+		closest_convex_pts = np.array(index_of_closest(contour, group_averages))
+		defects = cv2.convexityDefects(contour, closest_convex_pts)
+		if defects is None:
+			defects = []
+		convexity_defects.append(defects)
+
+	for i, hand_defects in enumerate(convexity_defects):
+		contour = hand_contours[i]
+		centre = centre_of_contour(contour)
+		fingertips = []
+		for j, defects in enumerate(hand_defects):
+			s = defects[0][0]
+			e = defects[0][1]
+			f = defects[0][2]
+
+			start = tuple(contour[s][0])
+			end = tuple(contour[e][0])
+			far = tuple(contour[f][0])
+
+			a = dist([start], [end])
+			b = dist([far], [start])
+			c = dist([far], [end])
+
+			with np.errstate(divide='ignore', invalid='ignore'):
+				angle_deg = np.degrees(np.arccos((b ** 2 + c ** 2 - a ** 2) / (2 * b * c)))
+
+			if angle_deg < hand_finder.ANGLE_MAX:
+				if start not in fingertips and start[1] < centre[1]:
+					fingertips.append(start)
+				if end not in fingertips and start[1] < centre[1]:
+					fingertips.append(end)
+
+		hands.append(fingertips)
+
+	return hands
+
+
+def hand_contours_in(video, frame_index, hand_finder):
+	"""Hand contours found in the synthetic video's (flat) keyboard at frame_index."""
+	keyboard = video.flat_keyboard.copy()
+	for tip, key in video.hands_at(frame_index):
+		video.draw_hand(keyboard, tip)
+	return hand_finder.get_hand_contours(hand_finder.get_skin_masks(keyboard).closed)
+
+
+def best_time(func, *args, repeats=3):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		func(*args)
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+
+def main():
+	hand_finder = HandFinder()
+	for name, octaves, resolution in (('720p', 3, (1280, 720)), ('1080p', 5, (1920, 1080)), ('4K', 7, (3840, 2160))):
+		video = SyntheticVideo(octaves, resolution)
+		frames = [hand_contours_in(video, frame_index, hand_finder) for frame_index in range(0, 300, 7)]
+		for hand_contours in frames:
+			assert find_fingertips_loop(hand_finder, hand_contours) == hand_finder.find_fingertips(hand_contours, None), 'outputs differ'
+
+		before = best_time(lambda: [find_fingertips_loop(hand_finder, hand_contours) for hand_contours in frames]) / len(frames)
+		after = best_time(lambda: [hand_finder.find_fingertips(hand_contours, None) for hand_contours in frames]) / len(frames)
+		points = np.mean([sum(len(contour) for contour in hand_contours) for hand_contours in frames])
+		print('{:>5}: {:.0f} contour points per frame, fingertips {:7.2f} ms -> {:5.2f} ms ({:.0f}x)'.format(
+			name, points, before * 1000, after * 1000, before / after
+		))
+
+
+if __name__ == '__main__':
+	main()
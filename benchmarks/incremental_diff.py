@@ -0,0 +1,92 @@
+"""Compares the incremental pressed key diff with a full recompute, at a range of dirty thresholds:
+how many tiles were recomputed, how many pixels of the binary diff and which pressed keys differ, and
+how long finding the pressed keys took.
+
+Usage: python benchmarks/incremental_diff.py [video_name] [--thresholds 0 2 4 8] [--frames N]
+Run from the repository root, so that the video is found in ./data.
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from piano_vision.main import PianoVision
+from piano_vision.processors import PressedKeyDetector
+from piano_vision.video_reader import VideoReader
+
+
+class Run:
+	"""A pressed key detector and how far its results have strayed from the full recompute's."""
+	def __init__(self, name, detector):
+		self.name = name
+		self.detector = detector
+		self.elapsed = 0.0
+		self.diff_frames = 0
+		self.diff_pixels = 0
+		self.key_frames = []  # frames where the pressed keys (before sticky smoothing) differ
+		self.sticky_frames = []  # and after sticky smoothing
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('video_name', nargs='?', default='canon_in_d')
+	parser.add_argument('--thresholds', type=int, nargs='+', default=[0, 2, 4, 8])
+	parser.add_argument('--frames', type=int, metavar='N', help='only compare the first N frames')
+	args = parser.parse_args()
+
+	piano_vision = PianoVision(args.video_name, headless=True, calibration_cache=False)
+	piano_vision.calibrate()
+	reference_frame, keys_manager = piano_vision.reference_frame, piano_vision.keys_manager
+	full = Run('full', PressedKeyDetector(reference_frame, keys_manager))
+	runs = [
+		Run('threshold {}'.format(threshold), PressedKeyDetector(
+			reference_frame, keys_manager, incremental_diff=True, dirty_threshold=threshold
+		))
+		for threshold in args.thresholds
+	]
+
+	frame_index = 0
+	with VideoReader(piano_vision.video_file) as video_reader:
+		frame = video_reader.read_frame()
+		while frame is not None and (args.frames is None or frame_index < args.frames):
+			keyboard = piano_vision.bounder.get_bounded_section(frame, piano_vision.bounds, piano_vision.rotation)
+			skin_masks = piano_vision.hand_finder.get_skin_masks(keyboard)
+			hand_contours = piano_vision.hand_finder.get_hand_contours(skin_masks.closed)
+			fingertips = [fingertip for hand in piano_vision.hand_finder.find_fingertips(hand_contours, keyboard) for fingertip in hand]
+
+			results = {}
+			for run in [full, *runs]:
+				start = time.perf_counter()
+				pressed_keys = run.detector.find_pressed_keys(keyboard, skin_masks.dilated, fingertips)
+				run.elapsed += time.perf_counter() - start
+				run.detector.process_sticky_pressed_changes(pressed_keys)
+				results[run] = pressed_keys, run.detector.currently_pressed
+
+			full_diff = full.detector.get_diff(keyboard, full.detector.ref_frame, skin_masks.dilated)
+			for run in runs:
+				pixels = cv2.countNonZero(cv2.compare(run.detector.diff_result, full_diff, cv2.CMP_NE))
+				run.diff_frames += pixels > 0
+				run.diff_pixels += pixels
+				if results[run][0] != results[full][0]:
+					run.key_frames.append(frame_index)
+				if results[run][1] != results[full][1]:
+					run.sticky_frames.append(frame_index)
+
+			frame_index += 1
+			frame = video_reader.read_frame()
+
+	print('{} frames, {} pixels each'.format(frame_index, np.prod(reference_frame.shape[:2])))
+	print('{:<13} {:>10} {:>12} {:>12} {:>11} {:>12}  {}'.format(
+		'diff', 'tiles', 'diff frames', 'diff pixels', 'key frames', 'ms / frame', 'frames with different keys after smoothing'
+	))
+	print('{:<13} {:>9.1f}% {:>12} {:>12} {:>11} {:>12.2f}'.format('full', 100.0, '-', '-', '-', full.elapsed * 1000 / frame_index))
+	for run in runs:
+		print('{:<13} {:>9.1f}% {:>12} {:>12} {:>11} {:>12.2f}  {}'.format(
+			run.name, run.detector.recompute_ratio * 100, run.diff_frames, run.diff_pixels, len(run.key_frames),
+			run.elapsed * 1000 / frame_index, run.sticky_frames or 'none'
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,96 @@
+"""Compares motion gated transcription with processing every frame, at a range of change thresholds:
+how many frames were skipped, on which frames the pressed keys differ, and (if there is a ground
+truth) how the transcription scores.
+
+Usage: python benchmarks/motion_gating.py [video_name] [--thresholds 0.002 0.001 0.0005] [--frames N]
+Run from the repository root, so that the video is found in ./data and its ground truth in
+./ground_truths.
+"""
+import argparse
+import io
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # for calc_accuracy
+
+from calc_accuracy import score_lines
+from piano_vision.events import SnapshotLogSink
+from piano_vision.main import PianoVision
+from piano_vision.processors import ChangeTracker
+from piano_vision.video_reader import VideoReader
+
+
+class Run:
+	"""A transcription of the video and how far its pressed keys have strayed from the ungated one's."""
+	def __init__(self, video_name, name, threshold=None):
+		self.video_name = video_name
+		self.name = name
+		self.threshold = threshold
+		self.piano_vision = self.calibrated()
+		self.key_frames = []  # frames where the pressed keys (before sticky smoothing) differ
+		self.sticky_frames = []  # and after sticky smoothing
+
+	def calibrated(self):
+		piano_vision = PianoVision(self.video_name, headless=True, motion_gating=self.threshold is not None)
+		if self.threshold is not None:
+			piano_vision.change_tracker.threshold = self.threshold
+		piano_vision.calibrate()
+		return piano_vision
+
+	def score(self, truths):
+		"""Transcribe the whole video afresh and score its snapshots against the ground truth lines."""
+		piano_vision = self.calibrated()
+		with SnapshotLogSink(io.StringIO(), PianoVision.SNAPSHOT_INTERVAL, len(truths)) as log:
+			piano_vision.transcribe(log)
+			lines = log.file.getvalue().splitlines(keepends=True)
+		lines += ['{}: []\n'.format(i) for i in range(len(lines), len(truths))]
+		return score_lines(truths, lines)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('video_name', nargs='?', default='canon_in_d')
+	parser.add_argument('--thresholds', type=float, nargs='+', default=[ChangeTracker.CHANGE_THRESHOLD, 0.001, 0.0005])
+	parser.add_argument('--frames', type=int, metavar='N', help='only compare the first N frames')
+	args = parser.parse_args()
+
+	ungated = Run(args.video_name, 'ungated')
+	runs = [Run(args.video_name, 'threshold {:g}'.format(threshold), threshold) for threshold in args.thresholds]
+
+	frame_index = 0
+	with VideoReader(ungated.piano_vision.video_file) as video_reader:
+		frame = video_reader.read_frame()
+		while frame is not None and (args.frames is None or frame_index < args.frames):
+			results = {}
+			for run in [ungated, *runs]:
+				pressed_keys = run.piano_vision.process_frame(frame, sticky=False)[3]
+				run.piano_vision.pressed_key_detector.process_sticky_pressed_changes(pressed_keys)
+				# by name, since every run has keys of its own
+				results[run] = (
+					{str(key) for key in pressed_keys}, {str(key) for key in run.piano_vision.pressed_key_detector.currently_pressed}
+				)
+			for run in runs:
+				if results[run][0] != results[ungated][0]:
+					run.key_frames.append(frame_index)
+				if results[run][1] != results[ungated][1]:
+					run.sticky_frames.append(frame_index)
+			frame_index += 1
+			frame = video_reader.read_frame()
+
+	truth_file = Path('ground_truths/{}'.format(args.video_name))
+	truths = truth_file.read_text().splitlines(keepends=True) if truth_file.is_file() and args.frames is None else None
+
+	print('{} frames'.format(frame_index))
+	print('{:<17} {:>8} {:>11} {:>6}  {}'.format('gating', 'skipped', 'key frames', 'f1', 'frames with different keys after smoothing'))
+	for run in [ungated, *runs]:
+		change_tracker = run.piano_vision.change_tracker
+		print('{:<17} {:>7.1f}% {:>11} {:>6}  {}'.format(
+			run.name, change_tracker.skip_ratio * 100 if change_tracker else 0.0,
+			len(run.key_frames) if run is not ungated else '-',
+			'{:.3f}'.format(run.score(truths)['f1']) if truths else '-',
+			(run.sticky_frames or 'none') if run is not ungated else '',
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,45 @@
+"""Accuracy vs. speed of processing hands and pressed keys at a range of processing scales.
+
+Usage: python benchmarks/scales.py [video_name] [--scales 1 0.75 0.5 0.25]
+Run from the repository root, so that the video is found in ./data. Each scale transcribes the whole
+video headless, writing output/<video_name>-scale<scale>.log, which is then scored with
+calc_accuracy.py against ./ground_truths/<video_name> if there is one.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # for calc_accuracy
+
+from calc_accuracy import score
+from piano_vision.main import PianoVision
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('video_name', nargs='?', default='canon_in_d')
+	parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.75, 0.5, 0.25])
+	args = parser.parse_args()
+
+	has_ground_truth = Path('ground_truths/{}'.format(args.video_name)).exists()
+	rows = []
+	for scale in args.scales:
+		output_name = '{}-scale{:g}'.format(args.video_name, scale)
+		piano_vision = PianoVision(args.video_name, headless=True, processing_scale=scale, output_name=output_name)
+		fps = piano_vision.main_loop()
+		stats = score(args.video_name, 'output/{}.log'.format(output_name)) if has_ground_truth else None
+		rows.append((scale, fps, stats))
+
+	print()
+	print('scale      fps   precision   recall      f1')
+	for scale, fps, stats in rows:
+		if stats:
+			print('{:5g} {:8.1f} {:10.2f}% {:7.2f}% {:7.3f}'.format(
+				scale, fps, stats['precision'] * 100, stats['recall'] * 100, stats['f1']
+			))
+		else:
+			print('{:5g} {:8.1f}   (no ground truth)'.format(scale, fps))
+
+
+if __name__ == '__main__':
+	main()
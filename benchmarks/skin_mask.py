@@ -0,0 +1,56 @@
+"""Times HandFinder's skin classification by HSV conversion against its lookup table, on synthetic
+keyboards with hands at 720p, 1080p and 4K, checking that both classify every pixel the same.
+
+Usage: python benchmarks/skin_mask.py
+"""
+import time
+
+import numpy as np
+
+from synthetic import SyntheticVideo
+
+from piano_vision.processors import HandFinder
+
+
+def keyboards_of(video):
+	"""The synthetic video's (flat) keyboard with its hands drawn in, for a spread of frames."""
+	keyboards = []
+	for frame_index in range(0, 300, 7):
+		keyboard = video.flat_keyboard.copy()
+		for tip, key in video.hands_at(frame_index):
+			video.draw_hand(keyboard, tip)
+		keyboards.append(keyboard)
+	return keyboards
+
+
+def best_time(func, *args, repeats=3):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		func(*args)
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+
+def main():
+	start = time.perf_counter()
+	HandFinder.skin_lut_for(HandFinder.SKIN_LOWER, HandFinder.SKIN_UPPER)
+	print('lookup table built in {:.2f}s'.format(time.perf_counter() - start))
+
+	hsv_finder = HandFinder(reuse_buffers=True)
+	lut_finder = HandFinder(reuse_buffers=True, skin_lut=True)
+	for name, octaves, resolution in (('720p', 3, (1280, 720)), ('1080p', 5, (1920, 1080)), ('4K', 7, (3840, 2160))):
+		keyboards = keyboards_of(SyntheticVideo(octaves, resolution))
+		for keyboard in keyboards:
+			assert np.array_equal(hsv_finder.classify_skin(keyboard), lut_finder.classify_skin(keyboard)), 'outputs differ'
+
+		hsv = best_time(lambda: [hsv_finder.classify_skin(keyboard) for keyboard in keyboards]) / len(keyboards)
+		lut = best_time(lambda: [lut_finder.classify_skin(keyboard) for keyboard in keyboards]) / len(keyboards)
+		masks = best_time(lambda: [lut_finder.get_skin_masks(keyboard) for keyboard in keyboards]) / len(keyboards)
+		print('{:>5}: {}x{} keyboard, HSV {:6.2f} ms, lookup table {:6.2f} ms ({:.2f}x), with all morphology {:6.2f} ms'.format(
+			name, keyboards[0].shape[1], keyboards[0].shape[0], hsv * 1000, lut * 1000, hsv / lut, masks * 1000
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,163 @@
+"""Benchmark suite: times each processor and the whole pipeline on synthetic videos, scores the
+transcriptions against their ground truths, and checks both against a stored baseline.
+
+Usage: python benchmarks/suite.py [--configs NAME ...] [--regenerate] [--update-baseline] [--tolerance 0.25]
+Run from the repository root. Videos are rendered by synthetic.py into ./data the first time they are
+needed. Runs exit with status 1 if any metric has regressed beyond the tolerance. Accuracy doesn't
+depend on the machine, so its baseline is committed, in benchmarks/accuracy_baseline.json. Timings do,
+so theirs is kept with the machine that measures them, in benchmarks/baseline.json, which the first
+run stores. --update-baseline replaces both.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cv2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # for calc_accuracy and piano_vision
+
+from synthetic import SyntheticVideo
+
+from calc_accuracy import score
+from piano_vision.main import PianoVision
+from piano_vision.processors import KeyboardBounder, KeysManager
+
+BASELINE_FILE = Path(__file__).resolve().parent / 'baseline.json'  # timings, for this machine only
+ACCURACY_BASELINE_FILE = Path(__file__).resolve().parent / 'accuracy_baseline.json'
+
+CONFIGS = {
+	'synthetic_720p': dict(octaves=3, resolution=(1280, 720), frames=300),
+	'synthetic_1080p': dict(octaves=5, resolution=(1920, 1080), frames=300),
+	'synthetic_4k': dict(octaves=7, resolution=(3840, 2160), frames=150),
+}
+
+# Pipeline stages (as named by StageProfiler) that make up each processor's per-frame work
+PROCESSOR_STAGES = {
+	'keyboard_bounder': ['bounded_section'],
+	'hand_finder': ['skin_mask', 'hand_contours', 'fingertips'],
+	'pressed_key_detector': ['pressed_keys'],
+}
+ACCURACY_METRICS = ('precision', 'recall', 'f1')
+ACCURACY_TOLERANCE = 0.02  # absolute, as accuracy on synthetic videos should barely move
+
+
+def median_time(func, *args, repeats=5):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		func(*args)
+		times.append(time.perf_counter() - start)
+	return statistics.median(times)
+
+
+def run_config(name, config, regenerate=False):
+	"""Returns {metric: value} for one synthetic video. Timings are medians in milliseconds."""
+	video_file = Path('data/{}.mp4'.format(name))
+	if regenerate or not video_file.exists():
+		print('rendering {}'.format(video_file))
+		SyntheticVideo(**config).write(name)
+
+	metrics = {}
+
+	# Calibration, on the reference frame
+	reference_frame = cv2.imread('data/{}-f00.png'.format(name))
+	bounder = KeyboardBounder()
+	metrics['keyboard_bounder.calibrate_ms'] = median_time(bounder.find_bounds, reference_frame) * 1000
+	keyboard = bounder.get_bounded_section(reference_frame, bounder.find_bounds(reference_frame))
+	metrics['keys_manager.calibrate_ms'] = median_time(KeysManager, keyboard) * 1000
+
+	# Per-frame processing, end to end and per stage
+	Path('output').mkdir(exist_ok=True)
+	piano_vision = PianoVision(name, headless=True, calibration_cache=False, profile=True)
+	metrics['pipeline.fps'] = piano_vision.main_loop()
+	stages = piano_vision.profiler.summary()
+	for processor, stage_names in PROCESSOR_STAGES.items():
+		metrics['{}.frame_ms'.format(processor)] = sum(stages[stage]['p50_ms'] for stage in stage_names)
+	metrics['pipeline.frame_ms'] = stages['frame']['p50_ms']
+	metrics['pipeline.frame_p99_ms'] = stages['frame']['p99_ms']
+
+	stats = score(name, 'output/{}.log'.format(name))
+	for metric in ACCURACY_METRICS:
+		metrics['pipeline.{}'.format(metric)] = stats[metric]
+	return metrics
+
+
+def is_accuracy(metric):
+	return metric.rsplit('.', 1)[-1] in ACCURACY_METRICS
+
+
+def load_baseline(path):
+	return json.loads(path.read_text()) if path.exists() else {}
+
+
+def store_baseline(path, results, baseline, accuracy):
+	"""Update the baseline stored at path with either the accuracy metrics of results or the rest."""
+	for name, metrics in results.items():
+		baseline.setdefault(name, {}).update({metric: value for metric, value in metrics.items() if is_accuracy(metric) == accuracy})
+	path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+	print('baseline written to {}'.format(path))
+
+
+def regressions(results, baseline, tolerance):
+	"""Messages for every metric that is worse than the baseline by more than the tolerance: a
+	fraction of the baseline for timings and frame rates, ACCURACY_TOLERANCE for accuracy."""
+	found = []
+	for name, metrics in results.items():
+		for metric, value in metrics.items():
+			expected = baseline.get(name, {}).get(metric)
+			if expected is None:
+				continue
+			if metric.endswith('_ms'):
+				regressed = value > expected * (1 + tolerance)
+			elif metric.endswith('fps'):
+				regressed = value < expected * (1 - tolerance)
+			else:
+				regressed = value < expected - ACCURACY_TOLERANCE
+			if regressed:
+				found.append('{} {}: {:.3f} (baseline {:.3f})'.format(name, metric, value, expected))
+	return found
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--configs', nargs='+', choices=sorted(CONFIGS), default=sorted(CONFIGS))
+	parser.add_argument('--regenerate', action='store_true', help='render the videos again even if they exist')
+	parser.add_argument('--update-baseline', action='store_true', help='store these results as the new baseline')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, as a fraction of the baseline')
+	args = parser.parse_args()
+
+	results = {name: run_config(name, CONFIGS[name], args.regenerate) for name in args.configs}
+
+	timing_baseline, accuracy_baseline = load_baseline(BASELINE_FILE), load_baseline(ACCURACY_BASELINE_FILE)
+	baseline = {
+		name: {**timing_baseline.get(name, {}), **accuracy_baseline.get(name, {})}
+		for name in set(timing_baseline) | set(accuracy_baseline)
+	}
+	print()
+	for name, metrics in results.items():
+		print(name)
+		for metric, value in metrics.items():
+			expected = baseline.get(name, {}).get(metric)
+			print('  {:<36} {:10.3f}{}'.format(metric, value, '' if expected is None else '  (baseline {:.3f})'.format(expected)))
+
+	if args.update_baseline or not timing_baseline:
+		store_baseline(BASELINE_FILE, results, timing_baseline, accuracy=False)
+	if args.update_baseline or not accuracy_baseline:
+		store_baseline(ACCURACY_BASELINE_FILE, results, accuracy_baseline, accuracy=True)
+	if args.update_baseline:
+		return
+
+	found = regressions(results, baseline, args.tolerance)
+	if found:
+		print('\nREGRESSIONS')
+		for message in found:
+			print('  ' + message)
+		sys.exit(1)
+	print('\nno regressions')
+
+
+if __name__ == '__main__':
+	main()
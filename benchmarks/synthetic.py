@@ -0,0 +1,224 @@
+"""Renders synthetic keyboard videos with moving hands and pressed keys, plus matching ground truths.
+
+Usage: python benchmarks/synthetic.py [name] [--octaves N] [--resolution WxH] [--frames N] [--seed N]
+Run from the repository root. Writes data/<name>.mp4, the reference frame data/<name>-f00.png and
+ground_truths/<name>, so the video can be transcribed with run.py and scored with calc_accuracy.py.
+"""
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from piano_vision.main import PianoVision
+
+WHITE_NOTES = 'CDEFGAB'
+BLACK_AFTER = 'CDFGA'  # white notes that have a black key just to their right
+SKIN = (120, 160, 220)  # BGR
+
+
+class SyntheticVideo:
+	"""A keyboard of whole octaves from C to C, filmed from above with the usual slight perspective.
+
+	Each frame is drawn flat (already rectified) and then warped into the frame, so that the keyboard's
+	top edge is inset by KeyboardBounder.OFFSET like real footage. Two hands move to new keys around
+	every snapshot frame and, most of the time, press the key under their middle finger. Presses are centred on the snapshot frames and
+	change halfway between them, well clear of the sticky delay, so the ground truth is exact."""
+	BACKGROUND = 40
+	KEY_WHITE = 250
+	KEY_LINE = 215
+	KEY_BLACK = 15
+	BLACK_KEY_HEIGHT = 0.6  # fraction of the keyboard's height
+	INSET = 25  # matches KeyboardBounder.OFFSET
+	MOVE_FRAMES = 5
+	PRESS_FRAMES = 20
+	PRESS_PROBABILITY = 0.8
+	NOISE = 2.0  # standard deviation of per-frame sensor noise
+
+	def __init__(self, octaves=3, resolution=(1280, 720), frames=300, seed=0, fps=30):
+		self.width, self.height = resolution
+		self.frames = frames
+		self.fps = fps
+		self.seed = seed
+		self.interval = PianoVision.SNAPSHOT_INTERVAL
+
+		self.num_white = 7 * octaves + 1
+		self.key_width = self.width / self.num_white
+		self.keyboard_top = round(self.height * 0.42)
+		self.keyboard_height = round(self.height * 0.28)
+
+		# Key rectangles in flat keyboard coordinates, with the names KeysManager gives them
+		self.keys = []  # (name, x0, x1, is_black)
+		black_keys = []
+		for i in range(self.num_white):
+			self.keys.append((self.white_name(i), round(i * self.key_width), round((i + 1) * self.key_width), False))
+			if WHITE_NOTES[i % 7] in BLACK_AFTER and i < self.num_white - 1:
+				# KeysManager discards black keys much smaller than the rest, which with perfectly identical keys
+				# can happen from rounding alone, so alternate keys are made a couple of pixels wider
+				black_width = round(0.6 * self.key_width) - 1 + 2 * (len(black_keys) % 2)
+				x0 = round((i + 1) * self.key_width - black_width / 2)
+				black_keys.append((x0, x0 + black_width, WHITE_NOTES[i % 7]))
+		for j, (x0, x1, note) in enumerate(black_keys):
+			self.keys.append((self.black_name(j, note), x0, x1, True))
+
+		flat_corners = np.float32([[0, 0], [self.width, 0], [0, self.keyboard_height], [self.width, self.keyboard_height]])
+		top, bottom = self.keyboard_top, self.keyboard_top + self.keyboard_height
+		frame_corners = np.float32([[self.INSET, top], [self.width - self.INSET, top], [0, bottom], [self.width, bottom]])
+		self.perspective = cv2.getPerspectiveTransform(flat_corners, frame_corners)
+
+		self.flat_keyboard = self.draw_keyboard()
+		self.plan = self.plan_presses()
+
+	@staticmethod
+	def white_name(i):
+		"""KeysManager calls the first A (white key 5) A1, and counts octaves from A."""
+		octave = 1 + (i - 5) // 7 if i >= 5 else -((5 - i) // 7)
+		return '{}{}'.format(WHITE_NOTES[i % 7], octave)
+
+	@staticmethod
+	def black_name(j, note):
+		"""Likewise the first A# (black key 4) is A#1."""
+		octave = 1 + (j - 4) // 5 if j >= 4 else -((4 - j) // 5)
+		return '{}#{}'.format(note, octave)
+
+	def draw_keyboard(self):
+		keyboard = np.full((self.keyboard_height, self.width, 3), self.KEY_WHITE, np.uint8)
+		for name, x0, x1, is_black in self.keys:
+			if is_black:
+				cv2.rectangle(keyboard, (x0, 0), (x1, round(self.keyboard_height * self.BLACK_KEY_HEIGHT)), (self.KEY_BLACK,) * 3, cv2.FILLED)
+			elif x0 > 0:
+				cv2.line(keyboard, (x0, 0), (x0, self.keyboard_height), (self.KEY_LINE,) * 3, thickness=max(1, self.width // 1500))
+		return keyboard
+
+	def plan_presses(self):
+		"""For every snapshot, the key each hand moves to and whether it presses it."""
+		rng = np.random.default_rng(self.seed)
+		middle = self.width / 2
+		halves = ([key for key in self.keys if key[2] < middle], [key for key in self.keys if key[1] > middle])
+		plan = []
+		for snapshot in range(self.frames // self.interval + 2):
+			targets = []
+			for hand, half in enumerate(halves):
+				# Stay a few keys in from the middle so the hands never touch
+				candidates = [key for key in half if self.key_width * 3 < abs((key[1] + key[2]) / 2 - middle)]
+				black = rng.random() < 0.3
+				white_or_black = [key for key in candidates if key[3] == black] or candidates
+				key = white_or_black[rng.integers(len(white_or_black))]
+				targets.append((key, snapshot > 0 and rng.random() < self.PRESS_PROBABILITY))
+			plan.append(targets)
+		return plan
+
+	def fingertip_of(self, key):
+		"""Where the middle finger rests to press key."""
+		name, x0, x1, is_black = key
+		y = self.keyboard_height * (0.4 if is_black else 0.5)
+		return (x0 + x1) / 2, y
+
+	def hands_at(self, frame_index):
+		"""Middle fingertip position of each hand at frame_index, and the key it is pressing, or None."""
+		# Snapshot k's window runs from half an interval before it to half an interval after
+		snapshot, offset = divmod(frame_index + self.interval // 2, self.interval)
+		hands = []
+		for hand in range(2):
+			key, presses = self.plan[snapshot][hand]
+			tip = np.array(self.fingertip_of(key))
+			if offset < self.MOVE_FRAMES and snapshot > 0:
+				previous = np.array(self.fingertip_of(self.plan[snapshot - 1][hand][0]))
+				tip = previous + (tip - previous) * (offset + 1) / self.MOVE_FRAMES
+			press_start = (self.interval - self.PRESS_FRAMES) // 2
+			pressing = presses and press_start <= offset < press_start + self.PRESS_FRAMES
+			hands.append((tip, key if pressing else None))
+		return hands
+
+	def draw_press(self, keyboard, key, tip):
+		"""A pressed key drops away from the back of the keyboard, opening a dark gap at its far end."""
+		name, x0, x1, is_black = key
+		if not is_black:
+			# Only the gap between the neighbouring black keys is visible this far up a white key
+			x0, x1 = max(x0, round(tip[0] - 0.2 * self.key_width)), min(x1, round(tip[0] + 0.2 * self.key_width))
+		gap = max(2, round(self.key_width / 15))
+		colour = (80,) * 3 if is_black else (110,) * 3
+		cv2.rectangle(keyboard, (x0, 0), (x1 - 1, gap - 1), colour, cv2.FILLED)
+
+	def draw_hand(self, keyboard, tip):
+		scale_x, scale_y = self.key_width, self.keyboard_height
+		finger_length = 0.35 * scale_y
+		palm = (round(tip[0]), round(tip[1] + finger_length))
+		cv2.ellipse(keyboard, palm, (round(1.3 * scale_x), round(0.15 * scale_y)), 0, 0, 360, SKIN, cv2.FILLED)
+		half_width = max(2, round(0.17 * scale_x))
+		for finger in range(-2, 3):
+			x = round(tip[0] + finger * 0.5 * scale_x)
+			top = round(tip[1] + abs(finger) * 0.06 * scale_y)
+			cv2.rectangle(keyboard, (x - half_width, top), (x + half_width, palm[1]), SKIN, cv2.FILLED)
+			cv2.circle(keyboard, (x, top), half_width, SKIN, cv2.FILLED)
+
+	def to_frame(self, keyboard):
+		return cv2.warpPerspective(
+			keyboard, self.perspective, (self.width, self.height), flags=cv2.INTER_LINEAR,
+			borderMode=cv2.BORDER_CONSTANT, borderValue=(self.BACKGROUND,) * 3
+		)
+
+	def reference_frame(self):
+		return self.to_frame(self.flat_keyboard)
+
+	def render(self, frame_index, noise=False):
+		"""Returns frame frame_index and the names of the keys pressed in it."""
+		keyboard = self.flat_keyboard.copy()
+		hands = self.hands_at(frame_index)
+		for tip, key in hands:
+			if key:
+				self.draw_press(keyboard, key, tip)
+		for tip, key in hands:
+			self.draw_hand(keyboard, tip)
+		frame = self.to_frame(keyboard)
+
+		if noise and self.NOISE:
+			grain = np.empty(frame.shape, np.int16)
+			cv2.randn(grain, 0, self.NOISE)
+			frame = cv2.add(frame, grain, dtype=cv2.CV_8U)
+		return frame, {key[0] for tip, key in hands if key}
+
+	def ground_truth(self):
+		"""Lines in the format of the log PianoVision writes, for each snapshot frame in the video."""
+		lines = []
+		for snapshot in range(min(PianoVision.NUM_SNAPSHOTS, -(-self.frames // self.interval))):
+			pressed = [key for tip, key in self.hands_at(snapshot * self.interval) if key]
+			names = [key[0] for key in sorted(pressed, key=lambda key: key[1])]
+			lines.append('{}: [{}]\n'.format(snapshot, ', '.join(names)))
+		return lines
+
+	def write(self, name, data_dir='data', ground_truth_dir='ground_truths'):
+		Path(data_dir).mkdir(parents=True, exist_ok=True)
+		Path(ground_truth_dir).mkdir(parents=True, exist_ok=True)
+		cv2.imwrite('{}/{}-f00.png'.format(data_dir, name), self.reference_frame())
+
+		writer = cv2.VideoWriter('{}/{}.mp4'.format(data_dir, name), cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (self.width, self.height))
+		cv2.setRNGSeed(self.seed)  # for the noise
+		for frame_index in range(self.frames):
+			writer.write(self.render(frame_index, noise=True)[0])
+		writer.release()
+
+		with open('{}/{}'.format(ground_truth_dir, name), 'w') as ground_truth_file:
+			ground_truth_file.writelines(self.ground_truth())
+
+
+def parse_resolution(value):
+	width, height = value.lower().split('x')
+	return int(width), int(height)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('name', nargs='?', default='synthetic')
+	parser.add_argument('--octaves', type=int, default=3)
+	parser.add_argument('--resolution', type=parse_resolution, default=(1280, 720), metavar='WxH')
+	parser.add_argument('--frames', type=int, default=300)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	SyntheticVideo(args.octaves, args.resolution, args.frames, args.seed).write(args.name)
+	print('wrote data/{0}.mp4, data/{0}-f00.png and ground_truths/{0}'.format(args.name))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,70 @@
+"""Times KeysManager.thin_edges against the per-pixel loop it replaced, on 1080p and 4K keyboards.
+
+Usage: python benchmarks/thin_edges.py
+"""
+import time
+
+import cv2
+import numpy as np
+
+from piano_vision.processors import KeysManager
+
+
+def thin_edges_loop(cropped):
+	"""The original pure Python implementation, kept as the reference."""
+	cropped = cropped.copy()
+	for row in cropped:
+		for col, val in enumerate(row):
+			if val and col < len(row) - 3 and row[col + 2]:
+				row[col + 1] = val
+				row[col + 2] = 0
+				row[col] = 0
+			if val and col < len(row) - 2 and row[col + 1]:
+				row[col] = 0
+	return cropped
+
+
+def draw_keyboard(width, height, num_white_keys=52):
+	"""A flat, already rectified keyboard with some noise, roughly as KeysManager receives it."""
+	keyboard = np.full((height, width, 3), 245, np.uint8)
+	key_width = width / num_white_keys
+	for i in range(1, num_white_keys):
+		x = int(round(i * key_width))
+		cv2.line(keyboard, (x, 0), (x, height), (210, 210, 210), thickness=max(1, width // 1500))
+		if i % 7 not in (2, 5):
+			cv2.rectangle(keyboard, (int(x - key_width / 3), 0), (int(x + key_width / 3), int(height * 0.6)), (20, 20, 20), cv2.FILLED)
+	noise = np.random.default_rng(0).normal(0, 4, keyboard.shape)
+	return np.clip(keyboard + noise, 0, 255).astype(np.uint8)
+
+
+def edges_of(keyboard):
+	height = keyboard.shape[0]
+	cropped = keyboard[height - round(height / 3.5):height - round(height / 16)]
+	return cv2.Canny(cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY), 10, 30)
+
+
+def best_time(func, *args, repeats=3):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		func(*args)
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+
+def main():
+	for name, (width, height) in (('1080p', (1920, 300)), ('4K', (3840, 600))):
+		keyboard = draw_keyboard(width, height)
+		edges = edges_of(keyboard)
+		assert np.array_equal(thin_edges_loop(edges), KeysManager.thin_edges(edges)), 'outputs differ'
+
+		before = best_time(thin_edges_loop, edges, repeats=1)
+		after = best_time(KeysManager.thin_edges, edges)
+		calibration = best_time(KeysManager, keyboard)
+		print('{:>5} keyboard {}x{}: thinning {:8.1f} ms -> {:6.2f} ms ({:.0f}x), full calibration {:.1f} ms'.format(
+			name, width, height, before * 1000, after * 1000, before / after, calibration * 1000
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -1,35 +1,56 @@
 import sys
 
 
-def main(song, log):
+def score(song, log):
+	"""Compares a log from ./output with the ground truth for song, returning a dict of statistics."""
 	with open('ground_truths/{}'.format(song)) as ground_truth_file:
 		with open(log) as output_file:
-			correct = 0
-			false_positive = 0
-			false_negative = 0
-			total_truths = 0
-
-			truths = ground_truth_file.readlines()
-			outputs = output_file.readlines()
-
-			for i, truth in enumerate(truths):
-				truth = set(truth[truth.find('[') + 1:truth.find(']')].split(', '))
-				output = set(outputs[i][outputs[i].find('[') + 1:outputs[i].find(']')].split(', '))
-
-				correct += len(truth.intersection(output))
-				false_positive += len(output.difference(truth))
-				false_negative += len(truth.difference(output))
-				total_truths += len(truth)
-
-			precision = correct / (correct + false_negative)
-			recall = correct / (correct + false_positive)
-			f1 = 2 * (precision * recall) / (precision + recall)
-			print('Correct: {}'.format(correct))
-			print('False Negatives: {}'.format(false_negative))
-			print('False Positives: {}'.format(false_positive))
-			print('Precision: {:.2f}%'.format(precision * 100))
-			print('Recall: {:.2f}%'.format(recall * 100))
-			print('F1 score: {:.3f}'.format(f1))
+			return score_lines(ground_truth_file.readlines(), output_file.readlines())
+
+
+def score_lines(truths, outputs):
+	"""Compares log lines with ground truth lines, returning a dict of statistics."""
+	correct = 0
+	false_positive = 0
+	false_negative = 0
+	total_truths = 0
+
+	for i, truth in enumerate(truths):
+		truth = set(truth[truth.find('[') + 1:truth.find(']')].split(', '))
+		output = set(outputs[i][outputs[i].find('[') + 1:outputs[i].find(']')].split(', '))
+
+		correct += len(truth.intersection(output))
+		false_positive += len(output.difference(truth))
+		false_negative += len(truth.difference(output))
+		total_truths += len(truth)
+
+	return stats_of(correct, false_negative, false_positive)
+
+
+def stats_of(correct, false_negative, false_positive):
+	"""Statistics from the counts of notes matched and missed, as for a log or several logs' totals."""
+	# Zero rather than an error when nothing at all was matched, as can happen with poor settings
+	precision = correct / (correct + false_negative) if correct else 0.0
+	recall = correct / (correct + false_positive) if correct else 0.0
+	f1 = 2 * (precision * recall) / (precision + recall) if correct else 0.0
+	return {
+		'correct': correct,
+		'false_negative': false_negative,
+		'false_positive': false_positive,
+		'precision': precision,
+		'recall': recall,
+		'f1': f1,
+	}
+
+
+def main(song, log):
+	stats = score(song, log)
+	print('Correct: {}'.format(stats['correct']))
+	print('False Negatives: {}'.format(stats['false_negative']))
+	print('False Positives: {}'.format(stats['false_positive']))
+	print('Precision: {:.2f}%'.format(stats['precision'] * 100))
+	print('Recall: {:.2f}%'.format(stats['recall'] * 100))
+	print('F1 score: {:.3f}'.format(stats['f1']))
 
 
 if __name__ == '__main__':
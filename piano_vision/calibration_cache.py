@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from .processors.keys_manager import Key, Note
+
+
+class CalibrationCache:
+	"""Stores the result of calibrating on a reference frame (bounds, rotation and labelled keys) as a
+	small JSON file named after a hash of the frame, so the same setup is only ever calibrated once."""
+	VERSION = 1  # bump whenever calibration changes in a way that makes old files wrong
+
+	def __init__(self, directory='cache/calibration'):
+		self.directory = Path(directory)
+
+	@classmethod
+	def key_for(cls, reference_frame, **options):
+		"""Hash of the frame's pixels and any options that affect calibration."""
+		digest = hashlib.sha256()
+		digest.update(repr((cls.VERSION, reference_frame.shape, reference_frame.dtype.str, sorted(options.items()))).encode())
+		digest.update(reference_frame.tobytes())
+		return digest.hexdigest()
+
+	def path_for(self, key):
+		return self.directory / '{}.json'.format(key)
+
+	def load(self, key):
+		"""Returns (bounds, rotation, white_keys, black_keys), or None if there is no usable entry."""
+		try:
+			with open(self.path_for(key)) as cache_file:
+				data = json.load(cache_file)
+			if data.get('version') != self.VERSION:
+				return None
+			bounds = [tuple(corner) for corner in data['bounds']]
+			white_keys = [self.key_from_list(key) for key in data['white_keys']]
+			black_keys = [self.key_from_list(key) for key in data['black_keys']]
+			return bounds, data['rotation'], white_keys, black_keys
+		except (OSError, ValueError, KeyError, TypeError, AttributeError):
+			# Missing, truncated or malformed, so calibrate afresh
+			return None
+
+	def save(self, key, bounds, rotation, white_keys, black_keys):
+		self.directory.mkdir(parents=True, exist_ok=True)
+		data = {
+			'version': self.VERSION,
+			'bounds': [[int(x), int(y)] for x, y in bounds],
+			'rotation': float(rotation),
+			'white_keys': [self.key_to_list(key) for key in white_keys],
+			'black_keys': [self.key_to_list(key) for key in black_keys],
+		}
+		# Written alongside and then moved into place, so an interrupted run can't leave a truncated file
+		with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as cache_file:
+			try:
+				json.dump(data, cache_file, separators=(',', ':'))
+			except BaseException:
+				os.unlink(cache_file.name)
+				raise
+		os.replace(cache_file.name, self.path_for(key))
+
+	def invalidate(self, key=None):
+		"""Deletes the entry for key, or every entry if no key is given."""
+		paths = [self.path_for(key)] if key else self.directory.glob('*.json')
+		for path in paths:
+			if path.exists():
+				path.unlink()
+
+	@staticmethod
+	def key_to_list(key):
+		return [int(key.x), int(key.y), int(key.width), int(key.height), key.note and key.note.name, key.octave]
+
+	@staticmethod
+	def key_from_list(values):
+		x, y, width, height, note, octave = values
+		return Key(x, y, width, height, note=note and Note[note], octave=octave)
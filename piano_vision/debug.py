@@ -0,0 +1,42 @@
+from collections import Counter
+from pathlib import Path
+
+import cv2
+
+
+class DebugSink:
+	"""Where the processors send their debug overlays, by name. This base class discards them and is
+	disabled, and processors only copy and draw on frames for their overlays if their sink is enabled,
+	so by default debugging costs nothing."""
+	enabled = False
+
+	def show(self, name, image):
+		pass
+
+
+NULL_SINK = DebugSink()
+
+
+class WindowSink(DebugSink):
+	"""Shows each overlay in a window of its name (refreshed by the main loop's cv2.waitKey)."""
+	enabled = True
+
+	def show(self, name, image):
+		cv2.imshow(name, image)
+
+
+class FileSink(DebugSink):
+	"""Writes every interval-th overlay of each name to directory/<name>-<count>.png."""
+	enabled = True
+
+	def __init__(self, directory='output/debug', interval=1):
+		self.directory = Path(directory)
+		self.interval = interval
+		self.counts = Counter()
+		self.directory.mkdir(parents=True, exist_ok=True)
+
+	def show(self, name, image):
+		count = self.counts[name]
+		self.counts[name] += 1
+		if count % self.interval == 0:
+			cv2.imwrite(str(self.directory / '{}-{:05d}.png'.format(name, count)), image)
@@ -0,0 +1,164 @@
+import json
+import struct
+from collections import namedtuple
+
+from .processors.keys_manager import Note
+
+NOTE_ON = 'note_on'
+NOTE_OFF = 'note_off'
+
+# A key being pressed or released, at a frame of the video and its timestamp (ms)
+NoteEvent = namedtuple('NoteEvent', ['type', 'key', 'frame_index', 'timestamp'])
+
+# Semitones above A, as KeysManager counts octaves from A
+SEMITONES = {
+	note: i for i, note in enumerate([
+		Note.A, Note.A_SHARP, Note.B, Note.C, Note.C_SHARP, Note.D, Note.D_SHARP,
+		Note.E, Note.F, Note.F_SHARP, Note.G, Note.G_SHARP,
+	])
+}
+A0_MIDI_NUMBER = 21
+
+
+def note_changes(previously_pressed, pressed, frame_index, timestamp):
+	"""Events turning previously_pressed into pressed: releases, then presses, each from left to right."""
+	for key in sorted(previously_pressed - pressed, key=lambda k: k.x):
+		yield NoteEvent(NOTE_OFF, key, frame_index, timestamp)
+	for key in sorted(pressed - previously_pressed, key=lambda k: k.x):
+		yield NoteEvent(NOTE_ON, key, frame_index, timestamp)
+
+
+def midi_number(key):
+	"""MIDI note number of a labelled key (KeysManager's A1 is MIDI's A1, 33), or None if unlabelled."""
+	if key.note is None or key.octave is None:
+		return None
+	number = A0_MIDI_NUMBER + 12 * key.octave + SEMITONES[key.note]
+	return number if 0 <= number <= 127 else None
+
+
+def event_dict(event):
+	"""JSON-ready form of a NoteEvent."""
+	return {
+		'type': event.type,
+		'note': str(event.key),
+		'midi': midi_number(event.key),
+		'frame': event.frame_index,
+		'timestamp': event.timestamp,
+	}
+
+
+def snapshot_line(snapshot_index, pressed_keys):
+	return '{}: [{}]\n'.format(snapshot_index, ', '.join([str(key) for key in sorted(pressed_keys, key=lambda k: k.x)]))
+
+
+class EventSink:
+	"""Somewhere to send note events. The file is opened once and written through a buffer; call
+	end() with the position just after the last frame once the video is done, then close(). An open
+	file object (such as an io.StringIO) may be given instead of a path."""
+	MODE = 'w'
+
+	def __init__(self, path):
+		self.path = path
+		self.file = path if hasattr(path, 'write') else open(path, self.MODE)
+
+	def write(self, event):
+		raise NotImplementedError
+
+	def end(self, frame_index, timestamp):
+		pass
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+class JsonlSink(EventSink):
+	"""One JSON object per line for every event."""
+	def write(self, event):
+		self.file.write(json.dumps(event_dict(event)) + '\n')
+
+
+class SnapshotLogSink(EventSink):
+	"""The log format calc_accuracy.py reads: the keys held down every interval frames, for the first
+	limit snapshots (or every snapshot if limit is None). Lines are echoed to stdout if echo is set."""
+	def __init__(self, path, interval, limit=None, echo=False):
+		super().__init__(path)
+		self.interval = interval
+		self.limit = limit
+		self.echo = echo
+		self.pressed = set()
+		self.next_snapshot = 0
+
+	def snapshot(self, snapshot_index, pressed_keys):
+		if self.limit is None or snapshot_index < self.limit:
+			line = snapshot_line(snapshot_index, pressed_keys)
+			self.file.write(line)
+			if self.echo:
+				print(line, end='')
+
+	def catch_up(self, frame_index):
+		"""Write every snapshot due before frame_index, which all see the keys held down now."""
+		while self.next_snapshot * self.interval < frame_index:
+			self.snapshot(self.next_snapshot, self.pressed)
+			self.next_snapshot += 1
+
+	def write(self, event):
+		self.catch_up(event.frame_index)
+		if event.type == NOTE_ON:
+			self.pressed.add(event.key)
+		else:
+			self.pressed.discard(event.key)
+
+	def end(self, frame_index, timestamp):
+		self.catch_up(frame_index)
+
+
+class MidiSink(EventSink):
+	"""A type 0 Standard MIDI File. Events are collected as they arrive and written on close, as the
+	track's length comes before its events. Unlabelled keys have no pitch, so are left out."""
+	MODE = 'wb'
+	TICKS_PER_QUARTER = 480
+	TEMPO = 500000  # microseconds per quarter note, i.e. 120 bpm
+	VELOCITY = 64
+
+	def __init__(self, path):
+		super().__init__(path)
+		self.messages = []  # (tick, status, note number)
+		self.end_tick = 0
+
+	def ticks(self, timestamp):
+		return round((timestamp or 0) * 1000 * self.TICKS_PER_QUARTER / self.TEMPO)
+
+	def write(self, event):
+		number = midi_number(event.key)
+		if number is not None:
+			self.messages.append((self.ticks(event.timestamp), 0x90 if event.type == NOTE_ON else 0x80, number))
+
+	def end(self, frame_index, timestamp):
+		self.end_tick = self.ticks(timestamp)
+
+	def close(self):
+		track = bytearray(b'\x00\xff\x51\x03' + self.TEMPO.to_bytes(3, 'big'))
+		tick = 0
+		for message_tick, status, number in self.messages:
+			track += self.variable_length(max(message_tick - tick, 0)) + bytes([status, number, self.VELOCITY])
+			tick = max(message_tick, tick)
+		track += self.variable_length(max(self.end_tick - tick, 0)) + b'\xff\x2f\x00'
+
+		self.file.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, self.TICKS_PER_QUARTER))
+		self.file.write(b'MTrk' + struct.pack('>I', len(track)) + track)
+		super().close()
+
+	@staticmethod
+	def variable_length(value):
+		encoded = [value & 0x7f]
+		value >>= 7
+		while value:
+			encoded.append(0x80 | (value & 0x7f))
+			value >>= 7
+		return bytes(reversed(encoded))
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .video_reader import VideoReader
+
+
+class FrameCache:
+	"""Stores every frame of a video as rectified by KeyboardBounder.get_bounded_section, in a raw array
+	file that later runs memory-map instead of decoding and warping the video again.
+
+	Entries are named after a hash of the video file (path, size and modification time) and the
+	calibration (bounds and rotation) used to rectify it, so recalibrating to different bounds, or
+	replacing the video, makes a new entry; older entries for the same video are deleted then."""
+	VERSION = 1  # bump whenever rectification changes in a way that makes old files wrong
+
+	def __init__(self, directory='cache/frames'):
+		self.directory = Path(directory)
+
+	@classmethod
+	def key_for(cls, video_file, bounds, rotation):
+		stat = os.stat(video_file)
+		calibration = [[int(x), int(y)] for x, y in bounds], float(rotation)
+		identity = (cls.VERSION, str(Path(video_file).resolve()), stat.st_size, stat.st_mtime_ns, calibration)
+		return hashlib.sha256(repr(identity).encode()).hexdigest()
+
+	def path_for(self, key):
+		return self.directory / '{}.raw'.format(key)
+
+	def metadata_path_for(self, key):
+		return self.directory / '{}.json'.format(key)
+
+	def open(self, video_file, bounder, bounds, rotation=0.0, prefetch=0):
+		"""Returns the video's CachedFrames for this calibration, rectifying the video first if needed."""
+		key = self.key_for(video_file, bounds, rotation)
+		cached = self.load(key)
+		if cached is None:
+			print('rectifying {} into the frame cache'.format(video_file))
+			self.save(key, video_file, bounder, bounds, rotation, prefetch)
+			cached = self.load(key)
+		print('{} rectified frames mapped from {}'.format(len(cached), self.path_for(key)))
+		return cached
+
+	def load(self, key):
+		"""Returns the entry's CachedFrames, or None if there is no complete, usable entry."""
+		try:
+			with open(self.metadata_path_for(key)) as metadata_file:
+				metadata = json.load(metadata_file)
+		except (OSError, ValueError):
+			return None
+		if metadata.get('version') != self.VERSION or not self.path_for(key).exists():
+			return None
+		return CachedFrames(self.path_for(key), metadata)
+
+	def save(self, key, video_file, bounder, bounds, rotation=0.0, prefetch=0):
+		"""Rectify every frame of the video into a new entry, replacing any others for the same video."""
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self.invalidate(video_file=video_file)
+
+		# The metadata is written last, so an interrupted save leaves nothing that load accepts
+		partial_path = self.path_for(key).with_suffix('.partial')
+		timestamps = []
+		shape = None
+		with VideoReader(video_file, prefetch=prefetch) as video_reader, open(partial_path, 'wb') as frames_file:
+			fps = video_reader.fps
+			frame = video_reader.read_frame()
+			while frame is not None:
+				keyboard = bounder.get_bounded_section(frame, bounds, rotation)
+				shape = keyboard.shape
+				keyboard.tofile(frames_file)
+				timestamps.append(video_reader.timestamp)
+				frame = video_reader.read_frame()
+		os.replace(partial_path, self.path_for(key))
+
+		metadata = {
+			'version': self.VERSION,
+			'video_file': str(Path(video_file).resolve()),
+			'bounds': [[int(x), int(y)] for x, y in bounds],
+			'rotation': float(rotation),
+			'shape': [len(timestamps), *(shape or (0, 0, 3))],
+			'dtype': np.dtype(np.uint8).str,
+			'fps': fps,
+			'timestamps': timestamps,
+		}
+		with open(self.metadata_path_for(key), 'w') as metadata_file:
+			json.dump(metadata, metadata_file, separators=(',', ':'))
+
+	def invalidate(self, key=None, video_file=None):
+		"""Deletes the entry for key, every entry for video_file, or every entry if neither is given."""
+		if key:
+			keys = [key]
+		else:
+			keys = [path.stem for path in self.directory.glob('*.json')]
+			if video_file:
+				video_file = str(Path(video_file).resolve())
+				keys = [key for key in keys if self.video_file_of(key) == video_file]
+		for key in keys:
+			for path in (self.metadata_path_for(key), self.path_for(key)):
+				if path.exists():
+					path.unlink()
+
+	def video_file_of(self, key):
+		try:
+			with open(self.metadata_path_for(key)) as metadata_file:
+				return json.load(metadata_file).get('video_file')
+		except (OSError, ValueError):
+			return None
+
+
+class CachedFrames:
+	"""A video's rectified frames, memory-mapped read only. Indexing returns a view straight into the
+	mapping (no copy, and nothing is read from disk until it is used), and reader() gives a VideoReader
+	lookalike over them. Pickles as the file's path, so copies in other processes map the same file."""
+	def __init__(self, path, metadata):
+		self.path = Path(path)
+		self.metadata = metadata
+		self.fps = metadata['fps']
+		self.timestamps = metadata['timestamps']
+		self.frames = np.memmap(self.path, dtype=np.dtype(metadata['dtype']), mode='r', shape=tuple(metadata['shape'])) \
+			if metadata['shape'][0] else np.empty(metadata['shape'], np.dtype(metadata['dtype']))
+
+	def __len__(self):
+		return len(self.frames)
+
+	def __getitem__(self, index):
+		return self.frames[index]
+
+	def __getstate__(self):
+		return {'path': self.path, 'metadata': self.metadata}
+
+	def __setstate__(self, state):
+		self.__init__(state['path'], state['metadata'])
+
+	def reader(self, start_frame=0):
+		return CachedFrameReader(self, start_frame)
+
+
+class CachedFrameReader:
+	"""Reads CachedFrames in order from start_frame, with the same interface as VideoReader."""
+	def __init__(self, cached_frames, start_frame=0):
+		self.cached_frames = cached_frames
+		self.start_frame = start_frame
+
+		# index and timestamp (ms) of the last frame returned by read_frame
+		self.frame_index = start_frame - 1
+		self.timestamp = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		pass
+
+	@property
+	def frame_count(self):
+		return len(self.cached_frames)
+
+	@property
+	def fps(self):
+		return self.cached_frames.fps
+
+	def read_frame(self):
+		if self.frame_index + 1 >= len(self.cached_frames):
+			return None
+		self.frame_index += 1
+		self.timestamp = self.cached_frames.timestamps[self.frame_index]
+		return self.cached_frames[self.frame_index]
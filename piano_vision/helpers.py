@@ -1,7 +1,41 @@
 import cv2
 import numpy as np
 import time
-from math import inf
+
+
+class BufferPool:
+	"""Named output arrays that are reused from frame to frame, for passing as OpenCV dst= arguments.
+
+	Arrays are only reallocated when the requested shape or dtype changes. When disabled, get returns
+	None so OpenCV allocates a fresh output each time, as if no dst was given."""
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.buffers = {}
+
+	def get(self, name, shape, dtype=np.uint8):
+		if not self.enabled:
+			return None
+		buffer = self.buffers.get(name)
+		if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+			buffer = self.buffers[name] = np.empty(shape, dtype=dtype)
+		return buffer
+
+	def get_flat(self, name, size, dtype=np.uint8):
+		"""A 1D array of at least size elements, for outputs whose size changes from frame to frame. It
+		grows to the largest size asked for, rather than being reallocated whenever the size changes."""
+		if not self.enabled:
+			return None
+		buffer = self.buffers.get(name)
+		if buffer is None or buffer.size < size or buffer.dtype != dtype:
+			buffer = self.buffers[name] = np.empty(max(size, 2 * (buffer.size if buffer is not None else 0)), dtype=dtype)
+		return buffer
+
+
+def rescale_points(points, scale):
+	"""Map integer pixel coordinates in an image resized by scale back to the original image, taking
+	each pixel's centre. Accepts any array-like of points whose last axis is (x, y)."""
+	points = np.asarray(points)
+	return np.round((points + 0.5) / scale - 0.5).astype(points.dtype)
 
 
 def rotate_image(image, angle):
@@ -30,54 +64,50 @@ def dist(p1, p2):
 	return np.sqrt(dx ** 2 + dy ** 2)
 
 
-def group(data, radius, dist_func=dist):
-	"""Clusters data that fall within radius of each by measure of dist_func"""
-	clustered = [[data[0]]]
-	for val in data[1:]:
-		if dist_func(val, clustered[-1][0]) < radius:
-			clustered[-1].append(val)
-		else:
-			clustered.append([val])
-
-	return clustered
-
-
-def avg_of_groups(point_groups):
-	"""Given a list of groups of 2D points, returns a list with the averages
-	of each group in the same order"""
-	point_avgs = []
-
-	for group in point_groups:
-		point_avg = [[0, 0]]
-
-		for point in group:
-			point_avg[0][0] += point[0][0]
-			point_avg[0][1] += point[0][1]
-
-		point_avg[0][0] = int(round(point_avg[0][0] / len(group)))
-		point_avg[0][1] = int(round(point_avg[0][1] / len(group)))
-
-		point_avgs += [point_avg]
-
-	return point_avgs
-
-
-def index_of_closest(data, points, dist_func=dist):
-	"""Generates an index of the closest values in data to values in points by
-	measure of dist_func"""
-	ioc = []
-
-	for point in points:
-		dist_curr = float(inf)
-		indx = -1
-		for i, dpoint in enumerate(data):
-			disti = dist_func(point, dpoint)
-			if disti < dist_curr:
-				dist_curr = disti
-				indx = i
-		ioc += [indx]
-
-	return ioc
+def group_starts(points, radius):
+	"""Splits an (n, 1, 2) array of points into runs, each of the points that fall within radius of the
+	run's first point, and returns the index at which each run starts"""
+	starts = []
+	start = 0
+	while start < len(points):
+		starts.append(start)
+		offsets = points[start + 1:, 0] - points[start, 0]
+		outside = np.flatnonzero(np.sqrt((offsets ** 2).sum(axis=1)) >= radius)
+		if not len(outside):
+			break
+		start += 1 + outside[0]
+	return np.array(starts)
+
+
+def avg_of_groups(points, starts):
+	"""Averages of the runs of an (n, 1, 2) array of points that begin at starts, rounded to the
+	nearest integer (halves to even), in the same shape"""
+	counts = np.diff(starts, append=len(points))
+	return np.round(np.add.reduceat(points, starts, axis=0) / counts[:, None, None]).astype(np.int64)
+
+
+def index_of_closest(data, points, buffer=None):
+	"""Index of the closest point in data to each of points, both (n, 1, 2) integer arrays of pixel
+	coordinates (first on ties). The squared distances are computed in buffer, an int32 array of at
+	least 3 * len(points) * len(data) elements, if one is given, rather than in new arrays."""
+	shape = (len(points), len(data))
+	size = shape[0] * shape[1]
+	if buffer is None:
+		buffer = np.empty(3 * size, dtype=np.int32)
+	distances, dy, along_points = (buffer[i * size:(i + 1) * size].reshape(shape) for i in range(3))
+	points = points.astype(np.int32)
+	# numpy buffers broadcast operands of arithmetic in temporaries, but not of copyto, so broadcast
+	# every operand to the full shape first
+	np.copyto(distances, data[:, 0, 0])
+	np.copyto(along_points, points[:, 0, 0, None])
+	distances -= along_points
+	distances *= distances
+	np.copyto(dy, data[:, 0, 1])
+	np.copyto(along_points, points[:, 0, 1, None])
+	dy -= along_points
+	dy *= dy
+	distances += dy
+	return np.argmin(distances, axis=1)
 
 
 def centre_of_contour(contour):
@@ -0,0 +1,179 @@
+import threading
+import time
+
+import cv2
+
+from .profiler import StageProfiler
+
+
+class FrameSource:
+	"""Frames arriving in real time, as from a camera. A background thread captures frames as fast as
+	they come and only the newest is kept, so a reader that falls behind skips frames rather than
+	working through a growing backlog. Subclasses implement capture()."""
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.latest = None  # (index, capture time from time.perf_counter, frame)
+		self.frames_captured = 0
+		self.finished = False
+		self.start_time = None
+
+		self.stopped = threading.Event()
+		self.capturer = None
+
+	def __enter__(self):
+		self.open()
+		self.stopped.clear()
+		self.start_time = time.perf_counter()
+		self.capturer = threading.Thread(target=self.capture_frames, name='{}-capture'.format(type(self).__name__), daemon=True)
+		self.capturer.start()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stopped.set()
+		self.capturer.join()
+		self.close()
+
+	def open(self):
+		pass
+
+	def close(self):
+		pass
+
+	def capture(self):
+		"""Blocks until the next frame has been captured and returns it, or None if there are no more."""
+		raise NotImplementedError
+
+	def capture_frames(self):
+		index = 0
+		while not self.stopped.is_set():
+			frame = self.capture()
+			captured_at = time.perf_counter()
+			with self.condition:
+				if frame is None:
+					self.finished = True
+				else:
+					self.latest = (index, captured_at, frame)
+					self.frames_captured += 1
+				self.condition.notify_all()
+			if frame is None:
+				return
+			index += 1
+
+	def read(self, after=-1):
+		"""The newest frame with an index above after, as (index, capture time, frame), waiting for one
+		to be captured if necessary. Returns None once the source has no more frames."""
+		with self.condition:
+			self.condition.wait_for(lambda: self.finished or (self.latest is not None and self.latest[0] > after))
+			if self.latest is not None and self.latest[0] > after:
+				return self.latest
+			return None
+
+
+class CameraSource(FrameSource):
+	"""A capture device number, or anything else cv2.VideoCapture can open, such as a stream URL."""
+	def __init__(self, device=0):
+		super().__init__()
+		self.device = device
+		self.video = None
+
+	def open(self):
+		self.video = cv2.VideoCapture(self.device)
+		if not self.video.isOpened():
+			raise IOError('could not open capture device {}'.format(self.device))
+
+	def close(self):
+		self.video.release()
+
+	def capture(self):
+		ret, frame = self.video.read()
+		return frame if ret else None
+
+
+class ReplaySource(FrameSource):
+	"""Replays a video file as if it were a camera running at fps (the file's own frame rate by
+	default): each frame becomes available at its due time, whether or not the last was read."""
+	def __init__(self, video_file, fps=None):
+		super().__init__()
+		self.video_file = video_file
+		self.fps = fps
+		self.video = None
+		self.next_frame_time = None
+
+	def open(self):
+		self.video = cv2.VideoCapture(self.video_file)
+		self.fps = self.fps or self.video.get(cv2.CAP_PROP_FPS) or 30
+		self.next_frame_time = None
+
+	def close(self):
+		self.video.release()
+
+	def capture(self):
+		ret, frame = self.video.read()
+		if not ret:
+			return None
+		if self.next_frame_time is None:
+			self.next_frame_time = time.perf_counter()
+		delay = self.next_frame_time - time.perf_counter()
+		if delay > 0:
+			self.stopped.wait(delay)
+		self.next_frame_time += 1 / self.fps
+		return frame
+
+
+class LiveScheduler:
+	"""Hands out frames from a FrameSource for processing, keeping up with the source.
+
+	Frames captured while the last one was being processed are skipped (superseded), and a frame
+	that is already older than the latency budget when it is reached (after a stall, say) is
+	dropped as stale in favour of the next one. done() records each frame's latency from capture to
+	result, and summary() reports the dropped frames and latency percentiles."""
+	def __init__(self, source, latency_budget=100):
+		self.source = source
+		self.latency_budget = latency_budget / 1000
+		self.last_index = source.latest[0] if source.latest else -1  # frames up to here are not counted
+		self.first_index = self.last_index + 1
+		self.frames_processed = 0
+		self.frames_stale = 0
+		self.frames_over_budget = 0
+		self.latency = StageProfiler()
+
+	def next_frame(self):
+		"""The newest frame not yet handed out that is within budget, as (index, capture time, frame),
+		or None once the source has no more frames."""
+		while True:
+			item = self.source.read(self.last_index)
+			if item is None:
+				return None
+			self.last_index = item[0]
+			if time.perf_counter() - item[1] <= self.latency_budget:
+				return item
+			self.frames_stale += 1
+
+	def done(self, captured_at):
+		"""Call once the result for the frame captured at captured_at is out."""
+		latency = time.perf_counter() - captured_at
+		self.latency.record('latency', latency)
+		self.frames_processed += 1
+		if latency > self.latency_budget:
+			self.frames_over_budget += 1
+
+	def summary(self):
+		frames = self.last_index + 1 - self.first_index
+		dropped = frames - self.frames_processed
+		return {
+			'frames': frames,
+			'processed': self.frames_processed,
+			'dropped': dropped,
+			'superseded': dropped - self.frames_stale,
+			'stale': self.frames_stale,
+			'over_budget': self.frames_over_budget,
+			**self.latency.summary().get('latency', {}),
+		}
+
+	def print_summary(self):
+		stats = self.summary()
+		print('Processed {processed} of {frames} live frames, dropped {dropped} ({superseded} superseded, {stale} stale)'.format(**stats))
+		if stats['processed']:
+			print('Latency (ms): mean {mean_ms:.1f}, p50 {p50_ms:.1f}, p95 {p95_ms:.1f}, p99 {p99_ms:.1f}, max {max_ms:.1f}; {over_budget} over the {budget:.0f}ms budget'.format(
+				budget=self.latency_budget * 1000, **stats
+			))
@@ -1,10 +1,17 @@
+import time
 from pathlib import Path
 
 import cv2
 import numpy as np
 
-from .helpers import rotate_image
-from .processors import KeysManager, KeyboardBounder, HandFinder, PressedKeyDetector
+from .calibration_cache import CalibrationCache
+from .debug import NULL_SINK
+from .events import note_changes, SnapshotLogSink
+from .frame_cache import FrameCache
+from .helpers import rotate_image, rescale_points, BufferPool
+from .live import LiveScheduler
+from .profiler import StageProfiler
+from .processors import KeysManager, KeyboardBounder, HandFinder, HandTracker, PressedKeyDetector, ChangeTracker
 from .video_reader import VideoReader
 
 
@@ -12,105 +19,291 @@ class PianoVision:
 	DELAY = 15  # delay between reading frames
 	SNAPSHOT_INTERVAL = 30  # how many frames between snapshots, videos usually 30fps
 	NUM_SNAPSHOTS = 20
+	LIVE_LATENCY_BUDGET = 100  # ms from a live frame being captured to its result
 
-	def __init__(self, video_name):
+	def __init__(
+		self, video_name, headless=False, prefetch=0, correct_rotation=False, reuse_buffers=False,
+		calibration_cache=True, recalibrate=False, motion_gating=False, incremental_diff=False,
+		processing_scale=1.0, output_name=None, profile=False, frame_cache=False, debug=None, skin_lut=False,
+		rolling_reference=0.0, hand_tracking=False
+	):
 		self.video_name = video_name
+		self.output_name = output_name or video_name  # name of the log and snapshots written to ./output
+		self.headless = headless  # no windows, no key polling, no pacing delay
+		self.prefetch = prefetch  # frames to decode ahead on a background thread, 0 to decode inline
 		self.video_file = 'data/{}.mp4'.format(video_name)
 		self.ref_frame_file = 'data/{}-f00.png'.format(video_name)
 
 		self.reference_frame = None
+		# Calibrations are cached by reference frame; recalibrate ignores (and then replaces) cached ones
+		self.calibration_cache = CalibrationCache() if calibration_cache else None
+		self.recalibrate = recalibrate
 
-		self.bounder = KeyboardBounder()
+		# Reusing buffers means per-frame results are only valid until the next frame is processed
+		self.reuse_buffers = reuse_buffers
+		self.buffers = BufferPool(enabled=reuse_buffers)
+
+		# Processors send debug overlays here; by default nowhere, and none are drawn
+		self.debug = debug or NULL_SINK
+
+		self.bounder = KeyboardBounder(reuse_buffers=reuse_buffers, debug=self.debug)
 		self.bounds = [0, 0, 0, 0]
+		self.correct_rotation = correct_rotation  # straighten the keyboard using KeyboardBounder.find_rotation
+		self.rotation = 0.0
+		self.frame_cache = FrameCache() if frame_cache else None  # read rectified frames from here instead of the video
+		self.cached_frames = None
 
-		self.hand_finder = HandFinder()
+		# Hands and pressed keys are found at this fraction of the keyboard's resolution
+		self.processing_scale = processing_scale
+		# If skin_lut, skin is classified by looking up each colour in a table rather than converting to HSV
+		self.hand_finder = HandFinder(debug=self.debug, reuse_buffers=reuse_buffers, scale=processing_scale, skin_lut=skin_lut)
+		# If hand tracking, hands are only looked for in windows around where they are expected to be
+		self.hand_tracker = HandTracker(scale=processing_scale) if hand_tracking else None
 		self.keys_manager = None
 		self.pressed_key_detector = None
 
+		# If motion gating, frames where the keyboard hasn't changed reuse the last processed frame's detections
+		self.change_tracker = ChangeTracker() if motion_gating else None
+		self.last_detection = None
+		# If incremental diff, only the parts of the frame-vs-reference diff that have changed are recomputed
+		self.incremental_diff = incremental_diff
+		# If rolling_reference, the reference is updated with this weight each frame, see PressedKeyDetector
+		self.rolling_reference = rolling_reference
+
+		# Per-stage timings for every frame, see StageProfiler
+		self.profiler = StageProfiler(enabled=profile)
+
 		self.frame_counter = 0
+		self.snapshot_log = None
+		self.end_position = None  # (frame index, timestamp) just after the last frame, once note_events is done
 
-	def main_loop(self):
-		open('output/{}.log'.format(self.video_name), 'w').close()
+	def open_snapshot_log(self):
+		return SnapshotLogSink('output/{}.log'.format(self.output_name), self.SNAPSHOT_INTERVAL, self.NUM_SNAPSHOTS, echo=True)
+
+	def calibrate(self):
+		# Use initial frame file if it exists, otherwise just use first frame
+		if self.ref_frame_file and Path(self.ref_frame_file).exists():
+			reference_frame = cv2.imread(self.ref_frame_file)
+			if reference_frame is None:
+				raise IOError('could not read reference frame {}'.format(self.ref_frame_file))
+		else:
+			with VideoReader(self.video_file) as video_reader:
+				reference_frame = video_reader.read_frame()
+			if reference_frame is None:
+				raise IOError('no frames could be read from {}'.format(self.video_file))
+		self.handle_reference_frame(reference_frame)
 
-		with VideoReader(self.video_file) as video_reader:
+	def open_frames(self, start_frame=0):
+		"""Reader for the video from start_frame: its rectified frames if using the frame cache (once
+		calibrated), otherwise the frames themselves."""
+		if self.cached_frames is not None:
+			return self.cached_frames.reader(start_frame)
+		return VideoReader(self.video_file, prefetch=self.prefetch, start_frame=start_frame)
+
+	def main_loop(self):
+		self.calibrate()
+		with self.open_snapshot_log() as self.snapshot_log, self.open_frames() as video_reader:
 			paused = False
 			frame = video_reader.read_frame()
 
-			# Use initial frame file if it exists, otherwise just use first frame
-			if Path(self.ref_frame_file).exists():
-				self.handle_reference_frame(cv2.imread(self.ref_frame_file))
-			else:
-				self.handle_reference_frame(frame)
+			start_time = time.perf_counter()
+			frame_start = start_time  # when the current frame was asked for, for its frame-to-result latency
+			frames_processed = 0
 
 			# Loop through remaining frames
 			while frame is not None:
-				cv2.imshow('frame', frame)
-				keyboard = self.bounder.get_bounded_section(frame, self.bounds)
-				# cv2.imshow('post_warp', keyboard)
-
-				skin_mask = self.hand_finder.get_skin_mask(keyboard)
-
-				# Use morphological closing to join up hand segments
-				# TODO maybe replace this with joining nearby contours?
-				kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-				skin_mask_closed = cv2.morphologyEx(skin_mask, cv2.MORPH_CLOSE, kernel, iterations=3)
-				# cv2.imshow('skin_mask_closed', skin_mask_closed)
-				hand_contours = self.hand_finder.get_hand_contours(skin_mask_closed)
-
-				fingertips = self.hand_finder.find_fingertips(hand_contours, keyboard)
-				flat_fingertips = []
-				for hand in fingertips:
-					flat_fingertips.extend(hand)
-
-				pressed_keys = self.pressed_key_detector.detect_pressed_keys(keyboard, skin_mask, flat_fingertips)
-
-				# cv2.imshow('keyboard vs. ref', np.vstack([keyboard, self.reference_frame]))
-
-				# Show frame with keys overlaid
-				for key in self.keys_manager.white_keys:
-					x, y, w, h = key.x, key.y, key.width, key.height
-					cv2.rectangle(keyboard, (x, y), (x + w, y + h), color=(0, 0, 255), thickness=key in pressed_keys and cv2.FILLED or 1)
-					cv2.putText(keyboard, str(key), (x + 3, y + h - 10), cv2.FONT_HERSHEY_PLAIN, 0.75, color=(0, 0, 255))
-				for key in self.keys_manager.black_keys:
-					x, y, w, h = key.x, key.y, key.width, key.height
-					cv2.rectangle(keyboard, (x, y), (x + w, y + h), color=(255, 150, 75), thickness=key in pressed_keys and cv2.FILLED or 1)
-					cv2.putText(keyboard, str(key), (x, y + h - 10), cv2.FONT_HERSHEY_PLAIN, 0.75, color=(255, 150, 75))
-
-				if hand_contours:
-					cv2.drawContours(keyboard, tuple(hand_contours), -1, color=(0, 255, 0), thickness=1)
-
-				# Highlight detected fingertips
-				for hand in fingertips:
-					for finger in hand:
-						if finger:
-							cv2.circle(keyboard, finger, radius=5, color=(0, 255, 0), thickness=2)
-
-				cv2.imshow('keyboard', keyboard)
-
-				# Wait for 30ms then get next frame unless quit
-				pressed_key = cv2.waitKey(self.DELAY) & 0xFF
-				if pressed_key == 32:  # spacebar
-					paused = not paused
-				elif pressed_key == ord('r'):
-					self.handle_reference_frame(frame)
-				elif pressed_key == ord('q'):
-					break
+				if not self.headless:
+					cv2.imshow('frame', frame)
+				keyboard, hand_contours, fingertips, pressed_keys = self.process_frame(frame)
+				with self.profiler.stage('overlay'):
+					self.draw_overlay(keyboard, pressed_keys, hand_contours, fingertips)
+				self.profiler.record('frame', time.perf_counter() - frame_start)
+
+				frames_processed += 1
+
+				if not self.headless:
+					cv2.imshow('keyboard', keyboard)
+
+					# Wait for 30ms then get next frame unless quit
+					pressed_key = cv2.waitKey(self.DELAY) & 0xFF
+					if pressed_key == 32:  # spacebar
+						paused = not paused
+					elif pressed_key == ord('r') and self.cached_frames is None:  # the frame cache has no raw frames to recalibrate on
+						self.handle_reference_frame(frame)
+					elif pressed_key == ord('q'):
+						break
 				if not paused:
 					if self.frame_counter % self.SNAPSHOT_INTERVAL == 0:
 						snapshot_index = self.frame_counter // self.SNAPSHOT_INTERVAL
-						self.take_snapshot(snapshot_index, frame, keyboard, pressed_keys)
+						with self.profiler.stage('snapshot'):
+							self.take_snapshot(snapshot_index, frame, keyboard, pressed_keys)
 					self.frame_counter += 1
-					frame = video_reader.read_frame()
+					frame_start = time.perf_counter()
+					with self.profiler.stage('read'):
+						frame = video_reader.read_frame()
+				else:
+					frame_start = time.perf_counter()
+
+			elapsed = time.perf_counter() - start_time
+			fps = frames_processed / elapsed if elapsed > 0 else 0.0
+			print('Processed {} frames in {:.2f}s ({:.1f} fps)'.format(frames_processed, elapsed, fps))
+			if self.change_tracker:
+				print('Skipped {} unchanged frames ({:.1f}%)'.format(
+					self.change_tracker.frames_skipped, self.change_tracker.skip_ratio * 100
+				))
+			if self.hand_tracker:
+				print('Searched the whole frame for hands in {} frames ({:.1f}%)'.format(
+					self.hand_tracker.frames_searched, self.hand_tracker.search_ratio * 100
+				))
+			if self.incremental_diff:
+				print('Recomputed {:.1f}% of diff tiles'.format(self.pressed_key_detector.recompute_ratio * 100))
+			if self.profiler.enabled:
+				self.profiler.print_summary()
+			return fps
+
+	def process_frame(self, frame, sticky=True):
+		"""Run the per-frame pipeline. With sticky=False the raw detections for this frame alone are
+		returned and the pressed key detector's press/release state is left untouched."""
+		with self.profiler.stage('bounded_section'):
+			if self.cached_frames is not None:
+				# Already rectified, but read only, and the overlay is drawn on the keyboard
+				keyboard = self.buffers.get('keyboard', frame.shape)
+				if keyboard is None:
+					keyboard = frame.copy()
+				else:
+					np.copyto(keyboard, frame)
+			else:
+				keyboard = self.bounder.get_bounded_section(frame, self.bounds, self.rotation)
+		# cv2.imshow('post_warp', keyboard)
+
+		unchanged = False
+		if self.change_tracker:
+			with self.profiler.stage('change_tracker'):
+				unchanged = not self.change_tracker.process_frame(keyboard)
+		if unchanged and self.last_detection:
+			# Nothing has moved, so treat this frame as a repeat of the last one
+			hand_contours, fingertips, pressed_keys = self.last_detection
+		else:
+			hand_contours, fingertips, pressed_keys = self.detect(keyboard)
+			self.last_detection = hand_contours, fingertips, pressed_keys
+
+		if sticky:
+			with self.profiler.stage('sticky'):
+				self.pressed_key_detector.process_sticky_pressed_changes(pressed_keys)
+			pressed_keys = self.pressed_key_detector.currently_pressed
+
+		# cv2.imshow('keyboard vs. ref', np.vstack([keyboard, self.reference_frame]))
+		return keyboard, hand_contours, fingertips, pressed_keys
+
+	def detect(self, keyboard):
+		"""Find the hands, fingertips and the keys that look pressed in the keyboard image. Everything is
+		found at processing_scale, but hand contours and fingertips are returned in keyboard coordinates."""
+		profiler = self.profiler
+		if self.processing_scale != 1.0:
+			with profiler.stage('rescale'):
+				keyboard = cv2.resize(
+					keyboard, None, fx=self.processing_scale, fy=self.processing_scale, interpolation=cv2.INTER_AREA,
+					dst=self.buffers.get('scaled_keyboard', self.scaled_shape(keyboard.shape))
+				)
+		# The skin mask's morphology is done once, closed to join up hand segments for the hand finder and
+		# dilated for the pressed key detector
+		# TODO maybe replace the closing with joining nearby contours?
+		windows = self.hand_tracker.search_windows(keyboard.shape) if self.hand_tracker else None
+		with profiler.stage('skin_mask'):
+			skin_masks = self.hand_finder.get_skin_masks(keyboard, windows)
+		with profiler.stage('hand_contours'):
+			hand_contours = self.hand_finder.get_hand_contours(skin_masks.closed, windows)
+		if hand_contours is None:
+			# A hand has reached the edge of its window, or come into view outside them, so search the whole
+			# frame after all
+			windows = None
+			with profiler.stage('hand_search'):
+				skin_masks = skin_masks._replace(closed=self.hand_finder.close_skin_mask(skin_masks.opened))
+				hand_contours = self.hand_finder.get_hand_contours(skin_masks.closed)
+		if self.hand_tracker:
+			self.hand_tracker.update(hand_contours, searched=windows is None)
+
+		with profiler.stage('fingertips'):
+			fingertips = self.hand_finder.find_fingertips(hand_contours, keyboard)
+		if self.processing_scale != 1.0:
+			hand_contours = tuple(rescale_points(contour, self.processing_scale) for contour in hand_contours)
+			fingertips = [
+				[tuple(finger) for finger in rescale_points(hand, self.processing_scale).tolist()] if hand else []
+				for hand in fingertips
+			]
+		flat_fingertips = []
+		for hand in fingertips:
+			flat_fingertips.extend(hand)
+
+		with profiler.stage('pressed_keys'):
+			pressed_keys = self.pressed_key_detector.find_pressed_keys(keyboard, skin_masks.dilated, flat_fingertips)
+		return hand_contours, fingertips, pressed_keys
+
+	def scaled_shape(self, shape):
+		"""Shape of an image of the given shape once resized to processing_scale."""
+		height, width = shape[:2]
+		return (round(height * self.processing_scale), round(width * self.processing_scale), *shape[2:])
+
+	def draw_overlay(self, keyboard, pressed_keys, hand_contours, fingertips):
+		# Show frame with keys overlaid
+		for key in self.keys_manager.white_keys:
+			x, y, w, h = key.x, key.y, key.width, key.height
+			cv2.rectangle(keyboard, (x, y), (x + w, y + h), color=(0, 0, 255), thickness=key in pressed_keys and cv2.FILLED or 1)
+			cv2.putText(keyboard, str(key), (x + 3, y + h - 10), cv2.FONT_HERSHEY_PLAIN, 0.75, color=(0, 0, 255))
+		for key in self.keys_manager.black_keys:
+			x, y, w, h = key.x, key.y, key.width, key.height
+			cv2.rectangle(keyboard, (x, y), (x + w, y + h), color=(255, 150, 75), thickness=key in pressed_keys and cv2.FILLED or 1)
+			cv2.putText(keyboard, str(key), (x, y + h - 10), cv2.FONT_HERSHEY_PLAIN, 0.75, color=(255, 150, 75))
+
+		if hand_contours:
+			cv2.drawContours(keyboard, tuple(hand_contours), -1, color=(0, 255, 0), thickness=1)
+
+		# Highlight detected fingertips
+		for hand in fingertips:
+			for finger in hand:
+				if finger:
+					cv2.circle(keyboard, finger, radius=5, color=(0, 255, 0), thickness=2)
 
 	def handle_reference_frame(self, reference_frame):
-		rotation = self.bounder.find_rotation(reference_frame)
-		print('rotation: {}'.format(rotation))
-		# reference_frame = rotate_image(reference_frame, rotation)
+		cache_key, cached = None, None
+		if self.calibration_cache:
+			cache_key = self.calibration_cache.key_for(reference_frame, correct_rotation=self.correct_rotation)
+			if not self.recalibrate:
+				cached = self.calibration_cache.load(cache_key)
 
-		self.bounds = self.bounder.find_bounds(reference_frame)
-		self.reference_frame = self.bounder.get_bounded_section(reference_frame, self.bounds)
-		self.keys_manager = KeysManager(self.reference_frame)
-		self.pressed_key_detector = PressedKeyDetector(self.reference_frame, self.keys_manager)
+		if cached:
+			self.bounds, self.rotation, white_keys, black_keys = cached
+			print('calibration loaded from {}'.format(self.calibration_cache.path_for(cache_key)))
+			self.reference_frame = self.bounder.get_bounded_section(reference_frame, self.bounds, self.rotation).copy()
+			self.keys_manager = KeysManager(self.reference_frame, white_keys, black_keys, debug=self.debug)
+		else:
+			rotation = self.bounder.find_rotation(reference_frame)
+			print('rotation: {}'.format(rotation))
+			self.rotation = rotation if self.correct_rotation else 0.0
+
+			# Bounds are found on the straightened frame, but every frame is rotated and rectified in one warp
+			rotated_frame = rotate_image(reference_frame, self.rotation) if self.rotation else reference_frame
+			self.bounds = self.bounder.find_bounds(rotated_frame)
+			self.reference_frame = self.bounder.get_bounded_section(reference_frame, self.bounds, self.rotation).copy()
+			self.keys_manager = KeysManager(self.reference_frame, debug=self.debug)
+
+			if self.calibration_cache:
+				self.calibration_cache.save(
+					cache_key, self.bounds, self.rotation, self.keys_manager.white_keys, self.keys_manager.black_keys
+				)
+
+		if self.frame_cache:
+			self.cached_frames = self.frame_cache.open(self.video_file, self.bounder, self.bounds, self.rotation, self.prefetch)
+
+		self.pressed_key_detector = PressedKeyDetector(
+			self.reference_frame, self.keys_manager, debug=self.debug, reuse_buffers=self.reuse_buffers,
+			incremental_diff=self.incremental_diff, scale=self.processing_scale, reference_update_rate=self.rolling_reference
+		)
+		self.last_detection = None
+		if self.change_tracker:
+			self.change_tracker.reset()
+		if self.hand_tracker:
+			self.hand_tracker.reset()
 
 		print('{} black keys found'.format(len(self.keys_manager.black_keys)))
 		print('{} white keys found'.format(len(self.keys_manager.white_keys)))
@@ -118,10 +311,93 @@ class PianoVision:
 	def take_snapshot(self, snapshot_index, frame, keyboard, pressed_keys):
 		if snapshot_index < self.NUM_SNAPSHOTS:
 			cv2.imwrite(
-				'output/{}-snapshot{:02d}.png'.format(self.video_name, snapshot_index),
+				'output/{}-snapshot{:02d}.png'.format(self.output_name, snapshot_index),
 				np.vstack([frame, keyboard])
 			)
-			with open('output/{}.log'.format(self.video_name), 'a+') as log:
-				line = '{}: [{}]\n'.format(snapshot_index, ', '.join([str(key) for key in pressed_keys]))
-				log.write(line)
-				print(line, end='')
+			self.snapshot_log.snapshot(snapshot_index, pressed_keys)
+
+	def note_events(self):
+		"""Transcribe the whole video headless, yielding a NoteEvent whenever a key is pressed or released
+		(after sticky smoothing). Keys still held at the end are released just after the last frame."""
+		self.calibrate()
+		with self.open_frames() as video_reader:
+			frame = video_reader.read_frame()
+			if frame is None:
+				raise IOError('no frames could be read from {}'.format(self.video_file))
+			frame_interval = 1000 / video_reader.fps
+			pressed = set()
+			self.end_position = (0, 0.0)
+			while frame is not None:
+				frame_index, timestamp = video_reader.frame_index, video_reader.timestamp
+				pressed_keys = self.process_frame(frame)[3]
+				yield from note_changes(pressed, pressed_keys, frame_index, timestamp)
+				pressed = set(pressed_keys)
+				self.end_position = (frame_index + 1, timestamp + frame_interval)
+				frame = video_reader.read_frame()
+
+			yield from note_changes(pressed, set(), *self.end_position)
+
+	def transcribe(self, *sinks):
+		"""Stream the video's note events into each sink (see piano_vision/events.py), returning how many
+		there were. The sinks are ended but not closed."""
+		count = 0
+		for event in self.note_events():
+			for sink in sinks:
+				sink.write(event)
+			count += 1
+		for sink in sinks:
+			sink.end(*self.end_position)
+		return count
+
+	def live_loop(self, source, latency_budget=LIVE_LATENCY_BUDGET, reference_frame=None, sinks=()):
+		"""Transcribe frames from a FrameSource (see piano_vision/live.py) as they arrive, dropping frames
+		as needed to keep up. Calibrates on reference_frame, or the source's first frame if not given.
+		Note events go to each sink as they happen, timestamped from when their frame was captured
+		(ms since the source started). Returns the LiveScheduler, which holds the latency statistics."""
+		if self.frame_cache:
+			raise ValueError('the frame cache holds a video file\'s frames, so cannot be used live')
+		if reference_frame is not None:
+			self.handle_reference_frame(reference_frame)
+		with source:
+			if reference_frame is None:
+				first = source.read()
+				if first is None:
+					raise IOError('no frames from {}'.format(type(source).__name__))
+				self.handle_reference_frame(first[2])
+
+			scheduler = LiveScheduler(source, latency_budget)
+			pressed = set()
+			frame_index, timestamp = 0, 0.0
+			while True:
+				item = scheduler.next_frame()
+				if item is None:
+					break
+				frame_index, captured_at, frame = item
+				timestamp = (captured_at - source.start_time) * 1000
+				keyboard, hand_contours, fingertips, pressed_keys = self.process_frame(frame)
+				for event in note_changes(pressed, pressed_keys, frame_index, timestamp):
+					for sink in sinks:
+						sink.write(event)
+				pressed = set(pressed_keys)
+				scheduler.done(captured_at)
+
+				if not self.headless:
+					self.draw_overlay(keyboard, pressed_keys, hand_contours, fingertips)
+					cv2.imshow('frame', frame)
+					cv2.imshow('keyboard', keyboard)
+					pressed_key = cv2.waitKey(1) & 0xFF
+					if pressed_key == ord('r'):
+						self.handle_reference_frame(frame)
+					elif pressed_key == ord('q'):
+						break
+
+			for event in note_changes(pressed, set(), frame_index + 1, timestamp):
+				for sink in sinks:
+					sink.write(event)
+			for sink in sinks:
+				sink.end(frame_index + 1, timestamp)
+
+		scheduler.print_summary()
+		if self.profiler.enabled:
+			self.profiler.print_summary()
+		return scheduler
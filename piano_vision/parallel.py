@@ -0,0 +1,122 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from .main import PianoVision
+
+
+def transcribe_range(piano_vision, start, end, warmup):
+	"""Worker: process frames [start, end) of the video (end=None for the rest of it), after first
+	running the sticky stage over `warmup` earlier frames so its state matches a serial run.
+
+	Returns the sticky state on reaching `start` and at the end of the range, plus, for every frame in
+	the range, the ids of the raw and of the sticky pressed keys, and the worker's profiler samples."""
+	detector = piano_vision.pressed_key_detector
+
+	first = max(0, start - warmup)
+	start_state = None
+	raw, pressed = [], []
+	with piano_vision.open_frames(first) as video_reader:
+		frame = video_reader.read_frame()
+		while frame is not None and (end is None or video_reader.frame_index < end):
+			if video_reader.frame_index == start:
+				start_state = detector.sticky_state()
+
+			pressed_keys = piano_vision.process_frame(frame, sticky=False)[3]
+			detector.process_sticky_pressed_changes(pressed_keys)
+
+			if video_reader.frame_index >= start:
+				raw.append(tuple(key.id for key in pressed_keys))
+				pressed.append(tuple(np.flatnonzero(detector.pressed).tolist()))
+			frame = video_reader.read_frame()
+
+	return start_state, detector.sticky_state(), raw, pressed, piano_vision.profiler.samples
+
+
+class ParallelPianoVision(PianoVision):
+	"""Headless transcription of a single video split into frame ranges across a process pool.
+
+	Each worker gets a pickled copy of the calibrated pipeline. Ranges overlap their predecessor by
+	WARMUP_FRAMES so the sticky press/release state has settled by the time a range starts. The state
+	is checked at every boundary, and if a key was still flickering through the whole overlap the
+	range is replayed through the sticky stage from its raw detections, so the merged result always
+	matches a serial run exactly."""
+	WARMUP_FRAMES = 10
+	CHUNKS_PER_PROCESS = 4  # more ranges than processes evens out load
+	MIN_CHUNK_FRAMES = 100
+
+	def __init__(self, video_name, processes=None, warmup=WARMUP_FRAMES, **options):
+		if options.get('motion_gating'):
+			raise ValueError('motion gating depends on the whole video up to each frame, so cannot be split into ranges')
+		if options.get('rolling_reference'):
+			raise ValueError('the rolling reference depends on the whole video up to each frame, so cannot be split into ranges')
+		if options.get('incremental_diff'):
+			raise ValueError('the incremental diff depends on the whole video up to each frame, so cannot be split into ranges')
+		if options.get('hand_tracking'):
+			raise ValueError('hand tracking depends on the whole video up to each frame, so cannot be split into ranges')
+		super().__init__(video_name, headless=True, **options)
+		self.processes = processes or os.cpu_count()
+		self.warmup = warmup
+		self.pressed_per_frame = []  # sticky pressed keys for every frame of the video
+
+	def frame_ranges(self, frame_count):
+		chunks = max(1, min(self.processes * self.CHUNKS_PER_PROCESS, frame_count // self.MIN_CHUNK_FRAMES))
+		bounds = [round(i * frame_count / chunks) for i in range(chunks)]
+		# The last range runs to the end of the video, in case the container's frame count is off
+		return list(zip(bounds, [*bounds[1:], None]))
+
+	def main_loop(self):
+		self.calibrate()
+		with self.open_frames() as video_reader:
+			frame_count = video_reader.frame_count
+
+		start_time = time.perf_counter()
+		with ProcessPoolExecutor(self.processes, initializer=cv2.setNumThreads, initargs=(1,)) as executor:
+			futures = [
+				executor.submit(transcribe_range, self, start, end, self.warmup)
+				for start, end in self.frame_ranges(frame_count)
+			]
+			results = [future.result() for future in futures]
+		self.merge_results(results)
+		elapsed = time.perf_counter() - start_time
+
+		self.write_snapshots()
+
+		frames_processed = len(self.pressed_per_frame)
+		fps = frames_processed / elapsed if elapsed > 0 else 0.0
+		print('Processed {} frames in {:.2f}s ({:.1f} fps) using {} processes'.format(
+			frames_processed, elapsed, fps, self.processes
+		))
+		if self.profiler.enabled:
+			self.profiler.print_summary()
+		return fps
+
+	def merge_results(self, results):
+		detector = self.pressed_key_detector
+		keys = self.keys_manager.keys
+
+		self.pressed_per_frame = []
+		for start_state, end_state, raw, pressed, samples in results:
+			self.profiler.merge(samples)
+			if start_state == detector.sticky_state():
+				self.pressed_per_frame.extend({keys[i] for i in ids} for ids in pressed)
+				detector.set_sticky_state(end_state)
+			else:
+				for ids in raw:
+					detector.process_sticky_pressed_changes([keys[i] for i in ids])
+					self.pressed_per_frame.append(set(detector.currently_pressed))
+
+	def write_snapshots(self):
+		"""Write the same snapshots and log lines as a serial run, re-reading just the snapshot frames."""
+		snapshot_frames = range(0, min(len(self.pressed_per_frame), self.NUM_SNAPSHOTS * self.SNAPSHOT_INTERVAL), self.SNAPSHOT_INTERVAL)
+		with self.open_snapshot_log() as self.snapshot_log:
+			for frame_index in snapshot_frames:
+				with self.open_frames(frame_index) as video_reader:
+					frame = video_reader.read_frame()
+				keyboard, hand_contours, fingertips, _ = self.process_frame(frame, sticky=False)
+				pressed_keys = self.pressed_per_frame[frame_index]
+				self.draw_overlay(keyboard, pressed_keys, hand_contours, fingertips)
+				self.take_snapshot(frame_index // self.SNAPSHOT_INTERVAL, frame, keyboard, pressed_keys)
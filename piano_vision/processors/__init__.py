@@ -1,4 +1,6 @@
 from .keys_manager import KeysManager
 from .keyboard_bounder import KeyboardBounder
 from .hand_finder import HandFinder
+from .hand_tracker import HandTracker
 from .pressed_key_detector import PressedKeyDetector
+from .change_tracker import ChangeTracker
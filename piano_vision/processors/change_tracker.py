@@ -2,11 +2,42 @@ import cv2
 
 
 class ChangeTracker:
-	def __init__(self):
-		self.bg_subtractor = cv2.createBackgroundSubtractorMOG2()
+	"""Decides whether a frame of the keyboard has changed enough to be worth processing, by
+	background subtraction on a downscaled grey copy of it. A key pressed or released while the hand
+	on it stays still changes too little of the keyboard to count, so it is missed until the hand moves
+	or MAX_SKIPPED_FRAMES have been skipped (see benchmarks/motion_gating.py)."""
+	CHANGE_THRESHOLD = 0.002  # fraction of pixels that must be foreground for a frame to count as changed
+	SCALE = 0.25  # the foreground is estimated at this fraction of the keyboard's resolution
+	MAX_SKIPPED_FRAMES = 15  # process at least one frame in this many, however still the keyboard is
+
+	def __init__(self, threshold=CHANGE_THRESHOLD):
+		self.threshold = threshold
+		self.reset()
+
+	def reset(self):
+		self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+		self.frames_seen = 0
+		self.frames_skipped = 0
+		self.consecutive_skips = 0
+
+	@property
+	def skip_ratio(self):
+		return self.frames_skipped / self.frames_seen if self.frames_seen else 0.0
 
 	def process_frame(self, frame):
+		"""Returns whether the frame has changed, i.e. whether the rest of the pipeline should run on it."""
 		# Apply background subtractor
 		grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-		fg_mask = self.bg_subtractor.apply(grey)
+		small = cv2.resize(grey, None, fx=self.SCALE, fy=self.SCALE, interpolation=cv2.INTER_AREA)
+		fg_mask = self.bg_subtractor.apply(small)
 		# cv2.imshow('fg_mask', fg_mask)
+
+		self.frames_seen += 1
+		changed = cv2.countNonZero(fg_mask) >= self.threshold * fg_mask.size
+		if changed or self.consecutive_skips >= self.MAX_SKIPPED_FRAMES:
+			self.consecutive_skips = 0
+			return True
+
+		self.frames_skipped += 1
+		self.consecutive_skips += 1
+		return False
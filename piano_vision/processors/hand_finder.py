@@ -1,7 +1,18 @@
+from collections import namedtuple
+
 import cv2
 import numpy as np
 
-from piano_vision.helpers import avg_of_groups, index_of_closest, group, dist, centre_of_contour
+from piano_vision.debug import NULL_SINK
+from piano_vision.helpers import avg_of_groups, index_of_closest, group_starts, centre_of_contour, BufferPool
+
+# The skin mask at each stage of morphology: opened to remove specks of noise, closed to join up hand
+# segments (for finding hands), and dilated to cover the edges of the skin (for blanking it out when
+# looking for pressed keys)
+SkinMasks = namedtuple('SkinMasks', ['opened', 'closed', 'dilated'])
+
+# Skin lookup tables, by (SKIN_LOWER, SKIN_UPPER), see HandFinder.skin_lut_for
+SKIN_LUTS = {}
 
 
 class HandFinder:
@@ -14,88 +25,192 @@ class HandFinder:
 	MIN_CONTOUR_AREA = 150
 	MAX_DIST = 30
 	ANGLE_MAX = 180
+	SKIN_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+	CLOSING_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+	CLOSING_ITERATIONS = 3
+	DILATION_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
+	def __init__(self, debug=NULL_SINK, reuse_buffers=False, scale=1.0, skin_lut=False):
+		self.debug = debug  # where to send debug overlays, if enabled
+		# if using a lookup table, skin is classified straight from BGR without converting to HSV
+		self.skin_lut = self.skin_lut_for(self.SKIN_LOWER, self.SKIN_UPPER) if skin_lut else None
+		# frames are processed at this fraction of the keyboard's resolution, so sizes in pixels shrink too
+		self.min_contour_area = self.MIN_CONTOUR_AREA * scale ** 2
+		self.max_dist = self.MAX_DIST * scale
+		# if reusing buffers, the returned skin mask is overwritten by the next call
+		self.buffers = BufferPool(enabled=reuse_buffers)
+
+	@staticmethod
+	def skin_lut_for(lower, upper):
+		"""A table of whether each 24 bit colour is skin (255) or not (0), indexed by b + (g << 8) + (r << 16),
+		made by applying the HSV thresholds to every colour at once. Building one takes a fraction of a second
+		and 16MB, so each is built once per process and shared."""
+		bounds = (tuple(lower.tolist()), tuple(upper.tolist()))
+		if bounds not in SKIN_LUTS:
+			colours = np.empty((256, 256, 256, 3), dtype=np.uint8)  # indexed by r, g, b
+			levels = np.arange(256, dtype=np.uint8)
+			colours[..., 0] = levels
+			colours[..., 1] = levels[:, np.newaxis]
+			colours[..., 2] = levels[:, np.newaxis, np.newaxis]
+			hsv = cv2.cvtColor(colours.reshape(4096, 4096, 3), cv2.COLOR_BGR2HSV)
+			SKIN_LUTS[bounds] = cv2.inRange(hsv, lower, upper).reshape(-1)
+		return SKIN_LUTS[bounds]
+
+	def classify_skin(self, frame):
+		"""255 where frame's colour is within the skin thresholds, otherwise 0."""
+		mask_shape = frame.shape[:2]
+		if self.skin_lut is None:
+			hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=self.buffers.get('hsv', frame.shape))
+			return cv2.inRange(hsv, self.SKIN_LOWER, self.SKIN_UPPER, dst=self.buffers.get('skin_mask', mask_shape))
+
+		# Pack each pixel into one little-endian 32 bit word, b + (g << 8) + (r << 16) + (255 << 24), then
+		# take off the alpha to leave the table index
+		bgra = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst=self.buffers.get('bgra', (*mask_shape, 4)))
+		colours = bgra.view(np.uint32)[..., 0]
+		np.subtract(colours, np.uint32(0xFF000000), out=colours)
+		skin_mask = self.buffers.get('skin_mask', mask_shape)
+		if skin_mask is None:
+			skin_mask = np.empty(mask_shape, dtype=np.uint8)
+		return self.skin_lut.take(colours, out=skin_mask, mode='clip')
 
 	def get_skin_mask(self, frame):
-		hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-		skin_mask = cv2.inRange(hsv, self.SKIN_LOWER, self.SKIN_UPPER)
+		mask_shape = frame.shape[:2]
+		skin_mask = self.classify_skin(frame)
 
-		kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-		skin_mask = cv2.erode(skin_mask, kernel, iterations=1)
-		skin_mask = cv2.dilate(skin_mask, kernel, iterations=1)
+		eroded = cv2.erode(skin_mask, self.SKIN_KERNEL, dst=self.buffers.get('skin_mask_eroded', mask_shape), iterations=1)
+		skin_mask = cv2.dilate(eroded, self.SKIN_KERNEL, dst=skin_mask, iterations=1)
 
 		# cv2.imshow('skin_mask', skin_mask)
 		return skin_mask
 
-	def get_hand_contours(self, skin_mask):
+	def get_skin_masks(self, frame, windows=None):
+		"""The skin mask of frame at every stage of morphology (see SkinMasks), each computed once so the
+		hand finder and pressed key detector can share them. If windows (x0, y0, x1, y1) are given, the
+		mask is only closed inside them (see close_skin_mask)."""
+		opened = self.get_skin_mask(frame)
+		closed = self.close_skin_mask(opened, windows)
+		dilated = cv2.dilate(opened, self.DILATION_KERNEL, dst=self.buffers.get('skin_mask_dilated', opened.shape), iterations=1)
+		return SkinMasks(opened, closed, dilated)
+
+	@property
+	def window_padding(self):
+		"""How far the closing can carry a pixel's influence, so how far beyond a window the opened mask
+		must be closed for the closed mask inside it to come out the same as for the whole frame."""
+		return 2 * self.CLOSING_ITERATIONS * (max(self.CLOSING_KERNEL.shape) // 2)
+
+	def close_skin_mask(self, opened, windows=None):
+		"""The opened skin mask, closed. If windows are given, only they are closed, which is all the hand
+		search needs, and the mask is left as it was opened elsewhere."""
+		closed = self.buffers.get('skin_mask_closed', opened.shape)
+		if windows is None:
+			closed = cv2.morphologyEx(opened, cv2.MORPH_CLOSE, self.CLOSING_KERNEL, dst=closed, iterations=self.CLOSING_ITERATIONS)
+			# cv2.imshow('skin_mask_closed', closed)
+			return closed
+
+		if closed is None:
+			closed = opened.copy()
+		else:
+			np.copyto(closed, opened)
+		height, width = opened.shape
+		padding = self.window_padding
+		for x0, y0, x1, y1 in windows:
+			padded_x0, padded_y0 = max(x0 - padding, 0), max(y0 - padding, 0)
+			padded_x1, padded_y1 = min(x1 + padding, width), min(y1 + padding, height)
+			# Each window is a different size, so its closing is allocated afresh rather than reused
+			window_closed = cv2.morphologyEx(
+				opened[padded_y0:padded_y1, padded_x0:padded_x1], cv2.MORPH_CLOSE, self.CLOSING_KERNEL,
+				iterations=self.CLOSING_ITERATIONS
+			)
+			closed[y0:y1, x0:x1] = window_closed[y0 - padded_y0:y1 - padded_y0, x0 - padded_x0:x1 - padded_x0]
+		return closed
+
+	def get_hand_contours(self, skin_mask, windows=None):
+		"""The largest contours in skin_mask, which are taken to be the hands. If windows are given, only
+		they are searched, and None is returned if a contour reaches the edge of its window (other than at
+		the edge of the frame), as it might carry on outside it, or if there is enough skin outside the
+		windows to be a hand that has just come into view."""
 		# skin_mask = cv2.GaussianBlur(skin_mask, (3, 3), 0)
-		contours, hierarchy = cv2.findContours(skin_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-		largest_contours = sorted(contours, key=cv2.contourArea)[:-7:-1]  # 3 contours per hand
-
-		largest_contours = filter(lambda c: cv2.contourArea(c) > self.MIN_CONTOUR_AREA, largest_contours)
-		return tuple(largest_contours)
+		if windows is None:
+			contours, hierarchy = cv2.findContours(skin_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+		else:
+			height, width = skin_mask.shape
+			skin_inside = sum(cv2.countNonZero(skin_mask[y0:y1, x0:x1]) for x0, y0, x1, y1 in windows)
+			if cv2.countNonZero(skin_mask) - skin_inside > self.min_contour_area:
+				return None
+			contours = []
+			for x0, y0, x1, y1 in windows:
+				window_contours, hierarchy = cv2.findContours(
+					skin_mask[y0:y1, x0:x1], cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0)
+				)
+				for contour in window_contours:
+					x, y, w, h = cv2.boundingRect(contour)
+					if (0 < x0 == x) or (0 < y0 == y) or (x + w == x1 < width) or (y + h == y1 < height):
+						return None
+				contours.extend(window_contours)
+
+		areas = [cv2.contourArea(contour) for contour in contours]
+		largest = sorted(range(len(contours)), key=areas.__getitem__)[:-7:-1]  # 3 contours per hand
+		return tuple(contours[i] for i in largest if areas[i] > self.min_contour_area)
 
 	def find_fingertips(self, hand_contours, display_frame):
-		display_frame = display_frame.copy()
+		if self.debug.enabled:
+			display_frame = display_frame.copy()
 		hands = []
 		convexity_defects = []
 
 		for contour in hand_contours:
 			convex_pts = cv2.convexHull(contour)
-			group_averages = np.array(avg_of_groups(group(convex_pts, self.MAX_DIST)))
-
-			# TODO remove me once no longer need debug
-			last_pt = None
-			for item in group_averages:
-				pt = (item[0][0], item[0][1])
-				cv2.circle(display_frame, (pt[0], pt[1]), 3, color=(255, 0, 0), thickness=cv2.FILLED)
-				if last_pt is not None:
-					cv2.line(display_frame, (pt[0], pt[1]), (last_pt[0], last_pt[1]), color=(255, 0, 0), thickness=1)
-				last_pt = pt
-			cv2.line(display_frame,
-				(group_averages[0][0][0], group_averages[0][0][1]),
-				(group_averages[-1][0][0], group_averages[-1][0][1]),
-				color=(255, 0, 0), thickness=1
+			group_averages = avg_of_groups(convex_pts, group_starts(convex_pts, self.max_dist))
+
+			if self.debug.enabled:
+				last_pt = None
+				for item in group_averages:
+					pt = (item[0][0], item[0][1])
+					cv2.circle(display_frame, (pt[0], pt[1]), 3, color=(255, 0, 0), thickness=cv2.FILLED)
+					if last_pt is not None:
+						cv2.line(display_frame, (pt[0], pt[1]), (last_pt[0], last_pt[1]), color=(255, 0, 0), thickness=1)
+					last_pt = pt
+				cv2.line(display_frame,
+					(group_averages[0][0][0], group_averages[0][0][1]),
+					(group_averages[-1][0][0], group_averages[-1][0][1]),
+					color=(255, 0, 0), thickness=1
+				)
+
+			closest_convex_pts = index_of_closest(
+				contour, group_averages, self.buffers.get_flat('closest_distances', 3 * len(group_averages) * len(contour), np.int32)
 			)
-			# END REMOVE ME
-
-			closest_convex_pts = np.array(index_of_closest(contour, group_averages))
 			defects = cv2.convexityDefects(contour, closest_convex_pts)
 			if defects is None:
 				defects = []
 			convexity_defects.append(defects)
 
-		cv2.imshow('convex_hand', display_frame)
+		if self.debug.enabled:
+			self.debug.show('convex_hand', display_frame)
 
-		for i, hand_defects in enumerate(convexity_defects):
-			contour = hand_contours[i]
-			centre = centre_of_contour(contour)
-			fingertips = []
-			for j, defects in enumerate(hand_defects):
-				s = defects[0][0]
-				e = defects[0][1]
-				f = defects[0][2]
-				d = defects[0][3]
-
-				start = tuple(contour[s][0])
-				end = tuple(contour[e][0])
-				far = tuple(contour[f][0])
-
-				a = dist([start], [end])
-				b = dist([far], [start])
-				c = dist([far], [end])
-
-				angle_deg = np.degrees(np.arccos((b ** 2 + c ** 2 - a ** 2) / (2 * b * c)))
-
-				if angle_deg < self.ANGLE_MAX:
-					if start not in fingertips and start[1] < centre[1]:
-						fingertips.append(start)
-					if end not in fingertips and start[1] < centre[1]:
-						fingertips.append(end)
-
-			hands.append(fingertips)
+		for contour, defects in zip(hand_contours, convexity_defects):
+			hands.append(self.fingertips_of(contour, defects, centre_of_contour(contour)))
 
 		return hands
 
+	def fingertips_of(self, contour, defects, centre):
+		"""The start and end points of every convexity defect that is sharper than ANGLE_MAX and starts
+		above the hand's centre, in order and without repeats."""
+		if not len(defects):
+			return []
+		points = contour[:, 0]
+		start, end, far = points[defects[:, 0, 0]], points[defects[:, 0, 1]], points[defects[:, 0, 2]]
+
+		a = np.sqrt(((start - end) ** 2).sum(axis=1))
+		b = np.sqrt(((far - start) ** 2).sum(axis=1))
+		c = np.sqrt(((far - end) ** 2).sum(axis=1))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			angle_deg = np.degrees(np.arccos((b ** 2 + c ** 2 - a ** 2) / (2 * b * c)))
+
+		keep = (angle_deg < self.ANGLE_MAX) & (start[:, 1] < centre[1])
+		candidates = np.stack([start[keep], end[keep]], axis=1).reshape(-1, 2)
+		_, first = np.unique(candidates, axis=0, return_index=True)
+		return [tuple(point) for point in candidates[np.sort(first)].tolist()]
+
 	def process_frame(self, frame):
 		# cv2.drawContours(frame, largest_contours, -1, (255, 0, 255), thickness=cv2.FILLED)
 		# cv2.connectedComponents(skin_mask, skin)
@@ -0,0 +1,97 @@
+import math
+
+import cv2
+
+
+def centre_of_box(box):
+	x0, y0, x1, y1 = box
+	return (x0 + x1) / 2, (y0 + y1) / 2
+
+
+def merge_overlapping(boxes):
+	"""Replace boxes (x0, y0, x1, y1) that overlap with the box around them both, until none overlap."""
+	boxes = list(boxes)
+	merged = True
+	while merged:
+		merged = False
+		for i, (ax0, ay0, ax1, ay1) in enumerate(boxes):
+			for j in range(i + 1, len(boxes)):
+				bx0, by0, bx1, by1 = boxes[j]
+				if ax0 < bx1 and bx0 < ax1 and ay0 < by1 and by0 < ay1:
+					boxes[i] = (min(ax0, bx0), min(ay0, by0), max(ax1, bx1), max(ay1, by1))
+					del boxes[j]
+					merged = True
+					break
+			if merged:
+				break
+	return boxes
+
+
+class HandTracker:
+	"""Predicts where the hands will be in the next frame, from how their contours moved between the
+	last two, so that HandFinder need only search windows around them. The whole frame is searched
+	when there are no hands to track, when the windows would cover most of it anyway, and every
+	REFRESH_INTERVAL frames. HandFinder also falls back to searching the whole frame if a hand reaches
+	out of its window, or if there is enough skin outside the windows to be a hand coming into view."""
+	MARGIN = 40  # pixels around each hand's predicted position to search
+	REFRESH_INTERVAL = 15  # search the whole frame at least once in this many frames
+	MAX_COVERAGE = 0.6  # fraction of the frame beyond which windows aren't worth it
+
+	def __init__(self, scale=1.0):
+		# frames are processed at this fraction of the keyboard's resolution, so the margin shrinks too
+		self.margin = self.MARGIN * scale
+		self.reset()
+
+	def reset(self):
+		self.boxes = []  # bounding box (x0, y0, x1, y1) of each hand contour found in the last frame
+		self.previous_boxes = []  # and the frame before
+		self.frames_seen = 0
+		self.frames_searched = 0
+		self.frames_since_search = 0
+
+	@property
+	def search_ratio(self):
+		return self.frames_searched / self.frames_seen if self.frames_seen else 0.0
+
+	def search_windows(self, shape):
+		"""Windows (x0, y0, x1, y1) to search for hands in a frame of the given shape, or None to search
+		all of it. The windows don't overlap."""
+		if not self.boxes or self.frames_since_search + 1 >= self.REFRESH_INTERVAL:
+			return None
+		height, width = shape[:2]
+		windows = []
+		for box in self.boxes:
+			dx, dy = self.velocity_of(box)
+			x0, y0, x1, y1 = box
+			windows.append((
+				max(math.floor(x0 + dx - self.margin), 0), max(math.floor(y0 + dy - self.margin), 0),
+				min(math.ceil(x1 + dx + self.margin), width), min(math.ceil(y1 + dy + self.margin), height),
+			))
+		windows = merge_overlapping(windows)
+		if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in windows) > self.MAX_COVERAGE * width * height:
+			return None
+		return windows
+
+	def velocity_of(self, box):
+		"""How far box's centre moved since the frame before, taking the nearest box then to be the same."""
+		if not self.previous_boxes:
+			return 0, 0
+		x, y = centre_of_box(box)
+		previous_x, previous_y = min(
+			map(centre_of_box, self.previous_boxes), key=lambda centre: (centre[0] - x) ** 2 + (centre[1] - y) ** 2
+		)
+		return x - previous_x, y - previous_y
+
+	def update(self, hand_contours, searched):
+		"""Record the hand contours found in a frame, and whether the whole frame was searched for them."""
+		self.frames_seen += 1
+		if searched:
+			self.frames_searched += 1
+			self.frames_since_search = 0
+		else:
+			self.frames_since_search += 1
+		self.previous_boxes = self.boxes
+		self.boxes = []
+		for contour in hand_contours:
+			x, y, w, h = cv2.boundingRect(contour)
+			self.boxes.append((x, y, x + w, y + h))
@@ -2,12 +2,26 @@ import cv2
 import numpy as np
 from math import atan, degrees
 
+from piano_vision.debug import NULL_SINK
+from piano_vision.helpers import BufferPool
+
 
 class KeyboardBounder:
 	OFFSET = 25
+	# warpPerspective's fixed-point precision for interpolation
+	INTER_BITS = 5
+	INTER_TAB_SIZE = 1 << INTER_BITS
+
+	def __init__(self, reuse_buffers=False, debug=NULL_SINK):
+		self.debug = debug  # where to send debug overlays, if enabled
+		# if reusing buffers, the returned keyboard is overwritten by the next call
+		self.buffers = BufferPool(enabled=reuse_buffers)
+		self.calibration = None  # bounds, rotation and frame size that the cached warp maps are for
+		self.roi = None
+		self.map_xy = None
+		self.map_fraction = None
 
 	def find_rotation(self, frame) -> float:
-		frame = frame.copy()
 		grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 		edges = cv2.Canny(grey, 100, 200)
 		# cv2.imshow('post_canny', edges)
@@ -19,13 +33,15 @@ class KeyboardBounder:
 				for x1, y1, x2, y2 in line:
 					angle = degrees(atan((y2 - y1) / (x2 - x1)))
 					angles.append(angle)
-					cv2.line(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
 
-		# cv2.imshow('hough_lines', frame)
+		if self.debug.enabled:
+			frame = frame.copy()
+			for x1, y1, x2, y2 in (lines[:, 0] if lines is not None else []):
+				cv2.line(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
+			self.debug.show('hough_lines', frame)
 		return angles[int(len(angles) / 2)]  # return median angle
 
 	def find_bounds(self, frame):
-		frame = frame.copy()
 		hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
 		white = cv2.inRange(hsv, np.array([0, 0, 240]), np.array([255, 30, 255]))
 		# cv2.imshow('hsv_threshold', white)
@@ -43,19 +59,49 @@ class KeyboardBounder:
 		x, y, w, h = cv2.boundingRect(largest_contour)
 		return [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
 
-	def get_bounded_section(self, frame, bounds):
+	def get_bounded_section(self, frame, bounds, rotation=0.0):
+		"""Rotate the frame by rotation degrees and rectify the keyboard within bounds, in a single
+		remap using maps that are cached until the bounds, rotation or frame size change."""
+		calibration = (tuple(map(tuple, bounds)), rotation, frame.shape[:2])
+		if calibration != self.calibration:
+			self.roi, self.map_xy, self.map_fraction = self.build_warp_maps(frame.shape, bounds, rotation)
+			self.calibration = calibration
+
+		x, y, w, h = self.roi
+		keyboard = self.buffers.get('keyboard', (*self.map_fraction.shape, *frame.shape[2:]), frame.dtype)
+		return cv2.remap(frame[y:y + h, x:x + w], self.map_xy, self.map_fraction, cv2.INTER_LINEAR, dst=keyboard)
+
+	def build_warp_maps(self, frame_shape, bounds, rotation):
+		"""Returns the source region of interest and fixed-point remap maps relative to it, computed the
+		same way warpPerspective does internally."""
 		min_x, max_x, min_y, max_y = bounds[0][0], bounds[1][0], bounds[0][1], bounds[2][1]
+		width, height = max_x - min_x, max_y - min_y
 
 		corners_pre = np.float32([[min_x + self.OFFSET, min_y], [max_x - self.OFFSET, min_y], [min_x, max_y], [max_x, max_y]])
+		corners_post = np.float32([[0, 0], [width, 0], [0, height], [width, height]])
+		matrix = cv2.getPerspectiveTransform(corners_pre, corners_post)
+		if rotation:
+			# Same rotation as rotate_image, applied before the perspective transform
+			frame_centre = (frame_shape[1] / 2, frame_shape[0] / 2)
+			matrix = matrix @ np.vstack([cv2.getRotationMatrix2D(frame_centre, rotation, 1.0), [0, 0, 1]])
 
-		frame_quad = frame.copy()
-		corners = [corners_pre[0], corners_pre[1], corners_pre[3], corners_pre[2]]
-		for i, corner in enumerate(corners):
-			next_corner = corners[(i + 1) % 4]
-			cv2.line(frame_quad, (corner[0], corner[1]), (next_corner[0], next_corner[1]), color=(0, 100, 220),
-					 thickness=2)
-		# cv2.imshow('quadrilateral', frame_quad)
+		# Map every output pixel back to the frame, in 1/INTER_TAB_SIZE pixel fixed point
+		inverse = np.linalg.inv(matrix)
+		xs, ys = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+		src_x = inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]
+		src_y = inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]
+		src_w = inverse[2, 0] * xs + inverse[2, 1] * ys + inverse[2, 2]
+		scale = np.divide(self.INTER_TAB_SIZE, src_w, out=np.zeros_like(src_w), where=src_w != 0)
+		fixed_x = np.rint(src_x * scale).astype(np.int64)
+		fixed_y = np.rint(src_y * scale).astype(np.int64)
+		whole_x, whole_y = fixed_x >> self.INTER_BITS, fixed_y >> self.INTER_BITS
 
-		corners_post = np.float32([[0, 0], [max_x - min_x, 0], [0, max_y - min_y], [max_x - min_x, max_y - min_y]])
-		matrix = cv2.getPerspectiveTransform(corners_pre, corners_post)
-		return cv2.warpPerspective(frame, matrix, (max_x - min_x, max_y - min_y))
+		# Only the part of the frame that is sampled from (plus one pixel for interpolation) is needed
+		frame_h, frame_w = frame_shape[:2]
+		x0, y0 = np.clip(whole_x.min(), 0, frame_w), np.clip(whole_y.min(), 0, frame_h)
+		x1, y1 = np.clip(whole_x.max() + 2, x0, frame_w), np.clip(whole_y.max() + 2, y0, frame_h)
+		roi = (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+
+		map_xy = np.dstack([whole_x - x0, whole_y - y0]).astype(np.int16)
+		map_fraction = ((fixed_y & (self.INTER_TAB_SIZE - 1)) * self.INTER_TAB_SIZE + (fixed_x & (self.INTER_TAB_SIZE - 1))).astype(np.uint16)
+		return roi, map_xy, map_fraction
@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 from enum import Enum
+from piano_vision.debug import NULL_SINK
 from piano_vision.helpers import mean_and_standard_dev, apply_mask
 
 
@@ -22,8 +23,60 @@ class Note(Enum):
 		return self.name.replace('_SHARP', '#')
 
 
+NOTES = list(Note)
+
+
+class KeyTable:
+	"""Keys stored column-wise in NumPy arrays and indexed by key id, so per-key state and lookups
+	can be vectorised. Notes are stored as indexes into NOTES."""
+	NO_NOTE = -1
+	NO_OCTAVE = np.iinfo(np.int16).min
+
+	def __init__(self, size=0):
+		self.x = np.zeros(size, np.int32)
+		self.y = np.zeros(size, np.int32)
+		self.width = np.zeros(size, np.int32)
+		self.height = np.zeros(size, np.int32)
+		self.note = np.full(size, self.NO_NOTE, np.int8)
+		self.octave = np.full(size, self.NO_OCTAVE, np.int16)
+
+	def __len__(self):
+		return len(self.x)
+
+	@classmethod
+	def of(cls, keys):
+		"""A table of keys, whose ids are their positions in the list. The keys become views of it."""
+		table = cls(len(keys))
+		for key_id, key in enumerate(keys):
+			for column in ('x', 'y', 'width', 'height', 'note', 'octave'):
+				getattr(table, column)[key_id] = getattr(key.table, column)[key.id]
+			key.table, key.id = table, key_id
+		return table
+
+
+def key_column(name):
+	"""Property reading and writing a Key's value in column name of its table."""
+	def get_value(key):
+		return int(getattr(key.table, name)[key.id])
+
+	def set_value(key, value):
+		getattr(key.table, name)[key.id] = value
+	return property(get_value, set_value)
+
+
 class Key:
+	"""A lightweight view of one row of a KeyTable. A key made on its own has a table of its own,
+	until KeysManager gathers its keys into one table."""
+	__slots__ = ('table', 'id')
+
+	x = key_column('x')
+	y = key_column('y')
+	width = key_column('width')
+	height = key_column('height')
+
 	def __init__(self, x, y, width, height, note=None, octave=None):
+		self.table = KeyTable(1)
+		self.id = 0
 		self.x = x
 		self.y = y
 		self.width = width
@@ -31,6 +84,24 @@ class Key:
 		self.note = note
 		self.octave = octave
 
+	@property
+	def note(self):
+		index = self.table.note[self.id]
+		return NOTES[index] if index != KeyTable.NO_NOTE else None
+
+	@note.setter
+	def note(self, note):
+		self.table.note[self.id] = NOTES.index(note) if note is not None else KeyTable.NO_NOTE
+
+	@property
+	def octave(self):
+		octave = self.table.octave[self.id]
+		return int(octave) if octave != KeyTable.NO_OCTAVE else None
+
+	@octave.setter
+	def octave(self, octave):
+		self.table.octave[self.id] = octave if octave is not None else KeyTable.NO_OCTAVE
+
 	def __repr__(self) -> str:
 		return 'Key(note={}, octave={}, x={})'.format(self.note, self.octave, self.x)
 
@@ -42,17 +113,34 @@ class Key:
 
 
 class KeysManager:
-	def __init__(self, ref_frame):
+	def __init__(self, ref_frame, white_keys=None, black_keys=None, debug=NULL_SINK):
+		"""Finds and labels the keys in ref_frame, unless already labelled keys are given."""
 		self.ref_frame = ref_frame
+		self.debug = debug  # where to send debug overlays, if enabled
+
+		if white_keys is not None and black_keys is not None:
+			self.white_keys = list(white_keys)
+			self.black_keys = list(black_keys)
+		else:
+			self.find_keys()
 
+		# All keys, indexed by key id, their table, and per-pixel maps of key ids (-1 where there is no key).
+		# In key_map black keys take precedence over the white keys they overlap; white_key_map has only white keys.
+		self.keys = [*self.white_keys, *self.black_keys]
+		self.table = KeyTable.of(self.keys)
+		self.white_key_map = self.build_key_map(self.white_keys)
+		self.key_map = self.build_key_map(self.black_keys, self.white_key_map.copy(), first_id=len(self.white_keys))
+
+	def find_keys(self):
 		# Get black key contours
-		thresh = self.threshold(ref_frame)
+		thresh = self.threshold(self.ref_frame)
 		# cv2.imshow('black_keys_thresholded', thresh)
 		key_contours = self.find_key_contours(thresh)
 
-		display_frame = self.ref_frame.copy()
-		cv2.drawContours(display_frame, key_contours, -1, (255, 0, 255), thickness=1)
-		# cv2.imshow('black_keys_contours', display_frame)
+		if self.debug.enabled:
+			display_frame = self.ref_frame.copy()
+			cv2.drawContours(display_frame, key_contours, -1, (255, 0, 255), thickness=1)
+			self.debug.show('black_keys_contours', display_frame)
 
 		# Get a bounding rectangle for each black key
 		self.black_keys = list(map(lambda c: Key(*cv2.boundingRect(c)), key_contours))
@@ -87,23 +175,15 @@ class KeysManager:
 		cropped = cv2.Canny(cropped, 10, 30)
 		# cv2.imshow('white_key_edges_pre', cropped)
 
-		for row in cropped:
-			for col, val in enumerate(row):
-				if val and col < len(row) - 3 and row[col + 2]:
-					row[col + 1] = val
-					row[col + 2] = 0
-					row[col] = 0
-				if val and col < len(row) - 2 and row[col + 1]:
-					row[col] = 0
+		cropped = self.thin_edges(cropped)
 
 		# cv2.imshow('white_key_edges_post', cropped)
 
 		lines = cv2.HoughLinesP(cropped, 1, np.pi / 180, threshold=2, minLineLength=5, maxLineGap=5)
 		boundaries = {0}
 		if lines is not None:
-			for line in lines:
-				for x1, y1, x2, y2 in line:
-					boundaries.add(int(round((x1 + x2) / 2)))
+			# Midpoint of each line, rounding halves to even like round()
+			boundaries.update(np.round((lines[:, 0, 0] + lines[:, 0, 2]) / 2).astype(int).tolist())
 
 		boundaries.add(cropped.shape[1])
 		boundaries = sorted(boundaries)
@@ -124,6 +204,78 @@ class KeysManager:
 
 		return keys
 
+	@staticmethod
+	def thin_edges(edges):
+		"""Thin each horizontal run of edge pixels down to a single pixel.
+
+		Equivalent to scanning every row left to right, where a set pixel with another set pixel two
+		columns on moves one column right and absorbs that pixel, or otherwise clears itself if the next
+		pixel is set; the last column is never looked ahead to. Rather than scanning, each run of pixels
+		is resolved at once: runs of 3 or more end up on their second last pixel, and runs of 1 or 2 end
+		up on the last pixel, unless a run starts after a one pixel gap, in which case they absorb it and
+		end up on its second last pixel.
+		"""
+		rows, width = edges.shape
+		if width < 2:
+			return edges.copy()
+		thinned = np.zeros_like(edges)
+		thinned[:, -1] = edges[:, -1]
+
+		# Find the runs of set pixels in each row, ignoring the last column
+		padded = np.zeros((rows, width + 1), dtype=np.int8)
+		padded[:, 1:width] = edges[:, :-1] != 0
+		steps = np.diff(padded, axis=1)
+		run_rows, run_starts = np.nonzero(steps == 1)
+		run_ends = np.nonzero(steps == -1)[1] - 1
+		if not len(run_rows):
+			return thinned
+		lengths = run_ends - run_starts + 1
+
+		# A short run followed by a one pixel gap absorbs the next run, unless it was itself absorbed,
+		# so within a chain of such runs every other one is absorbed
+		gap_of_one = np.zeros(len(run_rows), dtype=bool)
+		gap_of_one[:-1] = (run_rows[1:] == run_rows[:-1]) & (run_starts[1:] == run_ends[:-1] + 2)
+		absorbs = (lengths <= 2) & gap_of_one
+		indices = np.arange(len(run_rows))
+		chain_starts = np.maximum.accumulate(np.where(absorbs & ~np.r_[False, absorbs[:-1]], indices, 0))
+		absorbs &= (indices - chain_starts) % 2 == 0
+		kept = ~np.r_[False, absorbs[:-1]]
+
+		finals = np.where(lengths >= 3, run_ends - 1, run_ends)
+		finals[absorbs] = run_ends[np.nonzero(absorbs)[0] + 1] - 1
+		thinned[run_rows[kept], finals[kept]] = edges[run_rows[kept], run_starts[kept]]
+		return thinned
+
+	def build_key_map(self, keys, key_map=None, first_id=0):
+		"""Label each pixel lying strictly inside one of keys with that key's id."""
+		if key_map is None:
+			key_map = np.full(self.ref_frame.shape[:2], -1, dtype=np.int16)
+		for key_id, key in enumerate(keys, start=first_id):
+			key_map[key.y + 1:key.y + key.height, key.x + 1:key.x + key.width] = key_id
+		return key_map
+
+	def key_ids_at(self, points, key_map=None):
+		"""Vectorised lookup of the key id at each (x, y) point, -1 where there is no key."""
+		if key_map is None:
+			key_map = self.key_map
+		points = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+		xs, ys = points[:, 0], points[:, 1]
+		h, w = key_map.shape
+		inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+		key_ids = np.full(len(points), -1, dtype=key_map.dtype)
+		key_ids[inside] = key_map[ys[inside], xs[inside]]
+		return key_ids
+
+	def all_key_ids_at(self, points):
+		"""Set of ids of every key containing any of the points, including white keys under black keys."""
+		key_ids = {*self.key_ids_at(points).tolist(), *self.key_ids_at(points, self.white_key_map).tolist()}
+		key_ids.discard(-1)
+		return key_ids
+
+	def key_at(self, x, y):
+		key_id = self.key_ids_at([(x, y)])[0]
+		return self.keys[key_id] if key_id >= 0 else None
+
 	def label_keys(self):
 		self.black_keys.sort(key=lambda k: k.x)
 		distances = []
@@ -1,115 +1,239 @@
 import cv2
+import numpy as np
 
-from piano_vision.helpers import apply_mask, centre_of_contour
+from piano_vision.debug import NULL_SINK
+from piano_vision.helpers import apply_mask, centre_of_contour, rescale_points, BufferPool
 from piano_vision.processors import KeysManager
 
 
 class PressedKeyDetector:
 	MIN_CONTOUR_AREA = 100
 	STICKINESS = 2
-
-	def __init__(self, ref_frame, keys_manager):
+	DIFF_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+	DIFF_SMOOTHING_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+	# How far a change in the grey diff can reach in the thresholded, morphed diff: 5 for the adaptive
+	# threshold, 4 + 4 for the dilate and erode, and 10 + 10 for the opening and closing
+	DIFF_RADIUS = 33
+	TILE_SIZE = 64
+	# Grey diff change (0-255) a tile can accumulate before it is recomputed in incremental mode. Only 0 is
+	# exact; see benchmarks/incremental_diff.py for how far other thresholds stray from a full recompute
+	DIRTY_THRESHOLD = 4
+	# Weight of each frame in the rolling reference, if on: changes settle in over about 1 / rate frames
+	REFERENCE_UPDATE_RATE = 0.01
+
+	def __init__(
+		self, ref_frame, keys_manager, debug=NULL_SINK, reuse_buffers=False, incremental_diff=False,
+		dirty_threshold=DIRTY_THRESHOLD, scale=1.0, reference_update_rate=0.0
+	):
+		# Frames are compared at this fraction of the reference frame's resolution, while keys (and
+		# fingertips) stay in full resolution coordinates
+		self.scale = scale
+		if scale != 1.0:
+			ref_frame = cv2.resize(ref_frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 		self.ref_frame = ref_frame
-		self.keys_manager: KeysManager = keys_manager
-		self.currently_pressed = set()
-		self.to_be_added = dict()
-		self.to_be_removed = dict()
-
-	def detect_pressed_keys(self, frame, skin_mask, fingertips=None):
-		frame = frame.copy()
-		# Dilate again to ensure that we don't include any small bits of skin
-		kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-		dilated_mask = cv2.dilate(skin_mask, kernel, iterations=1)
-
-		skin = apply_mask(frame, dilated_mask)
-		frame = cv2.subtract(frame, skin)
-		# cv2.imshow('skin_masked_out', frame)
+		# With a reference update rate the reference is a running average, into which each frame is blended
+		# wherever the keys can be seen at rest, so it follows gradual changes in lighting
+		self.reference_update_rate = reference_update_rate
+		if reference_update_rate:
+			self.ref_frame = ref_frame.copy()
+			self.reference_model = ref_frame.astype(np.float32)
+		self.min_contour_area = self.MIN_CONTOUR_AREA * scale ** 2
+		self.debug = debug  # where to send debug overlays, if enabled
+		self.buffers = BufferPool(enabled=reuse_buffers)
 
-		skin_ref = apply_mask(self.ref_frame, dilated_mask)
-		ref = cv2.subtract(self.ref_frame, skin_ref)
+		self.keys_manager: KeysManager = keys_manager
+		# Sticky press/release state, indexed by key id: whether each key is pressed, and whether it is
+		# waiting to be added or removed, with how many more frames it has to wait
+		num_keys = len(keys_manager.keys)
+		self.pressed = np.zeros(num_keys, bool)
+		self.adding = np.zeros(num_keys, bool)
+		self.add_count = np.zeros(num_keys, np.int32)
+		self.removing = np.zeros(num_keys, bool)
+		self.remove_count = np.zeros(num_keys, np.int32)
+
+		# In incremental mode only tiles whose grey diff has changed by more than dirty_threshold since they
+		# were last computed are recomputed, along with their neighbours within DIFF_RADIUS. With a
+		# threshold of 0 the result is identical to a full recompute.
+		self.incremental_diff = incremental_diff
+		self.dirty_threshold = dirty_threshold
+		self.diff_source = None  # grey diff that each pixel of diff_result was last computed from
+		self.diff_result = None
+		self.tiles_seen = 0
+		self.tiles_recomputed = 0
+
+	@property
+	def currently_pressed(self):
+		keys = self.keys_manager.keys
+		return {keys[key_id] for key_id in np.flatnonzero(self.pressed).tolist()}
+
+	def sticky_state(self):
+		"""The press/release state as tuples of key ids (and counts), for comparing and restoring."""
+		return (
+			tuple(np.flatnonzero(self.pressed).tolist()),
+			tuple(zip(np.flatnonzero(self.adding).tolist(), self.add_count[self.adding].tolist())),
+			tuple(zip(np.flatnonzero(self.removing).tolist(), self.remove_count[self.removing].tolist())),
+		)
+
+	def set_sticky_state(self, state):
+		pressed, adding, removing = state
+		for flags, counts, entries in ((self.adding, self.add_count, adding), (self.removing, self.remove_count, removing)):
+			flags[:] = False
+			for key_id, count in entries:
+				flags[key_id] = True
+				counts[key_id] = count
+		self.pressed[:] = False
+		self.pressed[list(pressed)] = True
+
+	@property
+	def recompute_ratio(self):
+		"""Fraction of diff tiles that incremental mode has had to recompute."""
+		return self.tiles_recomputed / self.tiles_seen if self.tiles_seen else 0.0
+
+	def detect_pressed_keys(self, frame, dilated_mask, fingertips=None):
+		pressed_keys = self.find_pressed_keys(frame, dilated_mask, fingertips)
+		self.process_sticky_pressed_changes(pressed_keys)
+		return self.currently_pressed
 
-		diff = self.get_diff(frame, ref)
+	def find_pressed_keys(self, frame, dilated_mask, fingertips=None):
+		"""Keys that look pressed in this frame alone, before any sticky smoothing. dilated_mask is the
+		skin mask dilated to ensure that we don't include any small bits of skin, as from
+		HandFinder.get_skin_masks. frame and dilated_mask are at the detector's scale, fingertips are in
+		full resolution coordinates."""
+		# Skin is blanked out of both the frame and the reference before comparing them
+		diff = self.get_diff(frame, self.ref_frame, dilated_mask)
 
 		contours, hierarchy = cv2.findContours(diff, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-		contours = tuple(filter(lambda c: cv2.contourArea(c) > self.MIN_CONTOUR_AREA, contours))
-		cv2.drawContours(frame, contours, -1, color=(0, 255, 0), thickness=cv2.FILLED)
-
+		contours = tuple(filter(lambda c: cv2.contourArea(c) > self.min_contour_area, contours))
 		centres = tuple(map(centre_of_contour, contours))
 
-		for centre in centres:
-			cv2.circle(frame, (centre[0], centre[1]), radius=5, color=(0, 0, 255), thickness=cv2.FILLED)
-		cv2.imshow('frame_with_diff', frame)
+		if self.debug.enabled:
+			display_frame = cv2.subtract(frame, apply_mask(frame, dilated_mask))
+			cv2.drawContours(display_frame, contours, -1, color=(0, 255, 0), thickness=cv2.FILLED)
+			for centre in centres:
+				cv2.circle(display_frame, (centre[0], centre[1]), radius=5, color=(0, 0, 255), thickness=cv2.FILLED)
+			self.debug.show('frame_with_diff', display_frame)
 
-		pressed_keys = set()
-		for centre in centres:
-			for key in [*self.keys_manager.white_keys, *self.keys_manager.black_keys]:
-				if key.x < centre[0] < key.x + key.width and key.y < centre[1] < key.y + key.height:
-					pressed_keys.add(key)
+		if self.scale != 1.0 and centres:
+			centres = rescale_points(centres, self.scale)
+
+		# A point on a black key also counts for the white key beneath it
+		pressed_ids = self.keys_manager.all_key_ids_at(centres)
 
 		if fingertips:
-			pressed_keys = tuple(filter(
-				# Filter pressed keys to only those which contain a fingertip
-				lambda k: any(map(lambda f: self.fingertip_within_key(f, k), fingertips)),
-				pressed_keys
-			))
+			# Filter pressed keys to only those which contain a fingertip
+			pressed_ids &= self.keys_manager.all_key_ids_at(fingertips)
 
-		self.process_sticky_pressed_changes(pressed_keys)
-		return self.currently_pressed
+		if self.reference_update_rate:
+			self.update_reference(frame, dilated_mask, pressed_ids.union(np.flatnonzero(self.pressed).tolist()))
+
+		pressed_keys = {self.keys_manager.keys[key_id] for key_id in pressed_ids}
+		return pressed_keys
 
 	def process_sticky_pressed_changes(self, pressed_keys):
-		# If a key was going to be added but is no longer pressed, remove from to_be_added
-		delete_after = []
-		for key in self.to_be_added:
-			if key not in pressed_keys:
-				delete_after.append(key)
-		for key in delete_after:
-			del self.to_be_added[key]
-
-		for key in pressed_keys:
-			# If a key was going to be removed but is now pressed again, delete from to_be_removed
-			if key in self.to_be_removed:
-				del self.to_be_removed[key]
-			if key not in self.currently_pressed:
-				# If the key is set to be added and is still pressed, reduce its counter by 1
-				if key in self.to_be_added:
-					self.to_be_added[key] -= 1
-					# Key is ready to be added
-					if self.to_be_added[key] == 0:
-						del self.to_be_added[key]
-						self.currently_pressed.add(key)
-				# Otherwise if we haven't seen this key before, add it in future
-				else:
-					self.to_be_added[key] = self.STICKINESS
-
-		delete_after = []
-		for key in self.currently_pressed:
-			if key not in pressed_keys:
-				if key in self.to_be_removed:
-					self.to_be_removed[key] -= 1
-					if self.to_be_removed[key] == 0:
-						del self.to_be_removed[key]
-						delete_after.append(key)
-				else:
-					self.to_be_removed[key] = self.STICKINESS
-		for key in delete_after:
-			self.currently_pressed.remove(key)
-
-	@staticmethod
-	def fingertip_within_key(fingertip, key):
-		return key.x < fingertip[0] < (key.x + key.width) and key.y < fingertip[1] < (key.y + key.height)
-
-	@staticmethod
-	def get_diff(frame, ref):
-		diff = cv2.absdiff(frame, ref)
-		diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+		pressed_now = np.zeros(len(self.pressed), bool)
+		pressed_now[[key.id for key in pressed_keys]] = True
+
+		# If a key was going to be added but is no longer pressed, it no longer is
+		self.adding &= pressed_now
+		# If a key was going to be removed but is now pressed again, it no longer is
+		self.removing &= ~pressed_now
+
+		# Keys pressed now but not yet down count down to being added, or start to if new
+		to_add = pressed_now & ~self.pressed
+		counting = to_add & self.adding
+		self.add_count[counting] -= 1
+		added = counting & (self.add_count == 0)
+		self.adding[added] = False
+		self.pressed[added] = True
+		new = to_add & ~counting
+		self.adding[new] = True
+		self.add_count[new] = self.STICKINESS
+
+		# Likewise keys down but not pressed now count down to being removed
+		to_remove = self.pressed & ~pressed_now
+		counting = to_remove & self.removing
+		self.remove_count[counting] -= 1
+		removed = counting & (self.remove_count == 0)
+		self.removing[removed] = False
+		self.pressed[removed] = False
+		new = to_remove & ~counting
+		self.removing[new] = True
+		self.remove_count[new] = self.STICKINESS
+
+	def update_reference(self, frame, dilated_mask, key_ids):
+		"""Blend frame into the rolling reference, except under skin and on the keys with key_ids (those
+		that are or may be pressed), so that a held key isn't learnt as being at rest."""
+		at_rest = cv2.bitwise_not(dilated_mask, dst=self.buffers.get('at_rest_mask', dilated_mask.shape))
+		table = self.keys_manager.table
+		for key_id in key_ids:
+			x, y = int(table.x[key_id] * self.scale), int(table.y[key_id] * self.scale)
+			x_end = int(np.ceil((table.x[key_id] + table.width[key_id]) * self.scale))
+			y_end = int(np.ceil((table.y[key_id] + table.height[key_id]) * self.scale))
+			at_rest[y:y_end, x:x_end] = 0
+
+		cv2.accumulateWeighted(frame, self.reference_model, self.reference_update_rate, mask=at_rest)
+		self.ref_frame = cv2.convertScaleAbs(self.reference_model, dst=self.ref_frame)
+		if self.debug.enabled:
+			self.debug.show('reference', self.ref_frame)
+
+	def get_diff(self, frame, ref, mask=None):
+		"""Binary image of where frame differs from ref, ignoring pixels under mask."""
+		grey_shape = frame.shape[:2]
+		diff = cv2.absdiff(frame, ref, dst=self.buffers.get('abs_diff', frame.shape))
+		diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY, dst=self.buffers.get('grey_diff', grey_shape))
+		if mask is not None:
+			# Zero where the mask is set, the same as blanking those pixels in both images beforehand
+			diff = cv2.subtract(diff, mask, dst=diff)
 		# diff = cv2.GaussianBlur(diff, (3, 3), 0)
-		diff = cv2.adaptiveThreshold(diff, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 11, 10)
+
+		if self.incremental_diff:
+			return self.update_diff_tiles(diff)
+		return self.threshold_diff(diff, self.buffers.get('binary_diff', grey_shape), self.buffers.get('morphed_diff', grey_shape))
+
+	def threshold_diff(self, diff, binary=None, morphed=None):
+		"""Turn a grey diff into a clean binary image. binary and morphed are optional output buffers."""
+		diff = cv2.adaptiveThreshold(diff, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 11, 10, dst=binary)
 		# cv2.imshow('binary_diff', diff)
-		kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-		diff = cv2.dilate(diff, kernel, iterations=2)
-		diff = cv2.erode(diff, kernel, iterations=2)
-		kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
-		diff = cv2.morphologyEx(diff, cv2.MORPH_OPEN, kernel, iterations=1)
-		diff = cv2.morphologyEx(diff, cv2.MORPH_CLOSE, kernel, iterations=1)
+		diff = cv2.dilate(diff, self.DIFF_KERNEL, dst=morphed, iterations=2)
+		diff = cv2.erode(diff, self.DIFF_KERNEL, dst=binary, iterations=2)
+		diff = cv2.morphologyEx(diff, cv2.MORPH_OPEN, self.DIFF_SMOOTHING_KERNEL, dst=morphed, iterations=1)
+		diff = cv2.morphologyEx(diff, cv2.MORPH_CLOSE, self.DIFF_SMOOTHING_KERNEL, dst=binary, iterations=1)
 		# cv2.imshow('morphed_diff', diff)
 		return diff
+
+	def update_diff_tiles(self, diff):
+		"""threshold_diff, recomputing only the tiles that have changed (plus a halo around them) and
+		reusing the cached result everywhere else."""
+		h, w = diff.shape
+		if self.diff_result is None or self.diff_result.shape != diff.shape:
+			self.diff_source = diff.copy()
+			self.diff_result = self.threshold_diff(diff).copy()
+			return self.diff_result
+
+		# Find the largest change within each tile since it was last computed
+		tile = self.TILE_SIZE
+		tiles_h, tiles_w = -(-h // tile), -(-w // tile)
+		change = np.zeros((tiles_h * tile, tiles_w * tile), dtype=np.uint8)
+		cv2.absdiff(diff, self.diff_source, dst=change[:h, :w])
+		tile_change = change.reshape(tiles_h, tile, tiles_w, tile).max(axis=(1, 3))
+		dirty = (tile_change > self.dirty_threshold).astype(np.uint8)
+
+		# Changes reach DIFF_RADIUS pixels into neighbouring tiles
+		halo_tiles = -(-self.DIFF_RADIUS // tile)
+		dirty = cv2.dilate(dirty, np.ones((2 * halo_tiles + 1, 2 * halo_tiles + 1), np.uint8))
+		self.tiles_seen += dirty.size
+		self.tiles_recomputed += cv2.countNonZero(dirty)
+
+		# Recompute each connected group of dirty tiles in one go, from its bounding box plus a halo
+		count, labels, stats, centroids = cv2.connectedComponentsWithStats(dirty, connectivity=8)
+		for tile_x, tile_y, tiles_across, tiles_down, area in stats[1:]:
+			x0, y0 = tile_x * tile, tile_y * tile
+			x1, y1 = min((tile_x + tiles_across) * tile, w), min((tile_y + tiles_down) * tile, h)
+			halo_x0, halo_y0 = max(x0 - self.DIFF_RADIUS, 0), max(y0 - self.DIFF_RADIUS, 0)
+			halo_x1, halo_y1 = min(x1 + self.DIFF_RADIUS, w), min(y1 + self.DIFF_RADIUS, h)
+
+			result = self.threshold_diff(np.ascontiguousarray(diff[halo_y0:halo_y1, halo_x0:halo_x1]))
+			self.diff_result[y0:y1, x0:x1] = result[y0 - halo_y0:y1 - halo_y0, x0 - halo_x0:x1 - halo_x0]
+			self.diff_source[y0:y1, x0:x1] = diff[y0:y1, x0:x1]
+
+		return self.diff_result
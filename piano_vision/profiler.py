@@ -0,0 +1,87 @@
+import csv
+import json
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+
+class StageProfiler:
+	"""Records the wall time of each named stage of the pipeline, for every frame, and summarises them
+	as latency percentiles. When disabled, stage() returns a shared do-nothing context manager and
+	record() returns straight away, so instrumented code costs next to nothing."""
+	PERCENTILES = (50, 95, 99)
+	NULL_STAGE = nullcontext()
+
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.samples = {}  # stage name -> list of durations in seconds, in the order the stages ran
+
+	def stage(self, name):
+		"""Context manager that times its body as one sample of the named stage."""
+		if not self.enabled:
+			return self.NULL_STAGE
+		return _Stage(self, name)
+
+	def record(self, name, seconds):
+		if self.enabled:
+			self.samples.setdefault(name, []).append(seconds)
+
+	def merge(self, samples):
+		"""Add samples recorded by another profiler, e.g. in a worker process."""
+		for name, durations in samples.items():
+			self.samples.setdefault(name, []).extend(durations)
+
+	def summary(self):
+		"""Per stage: sample count, total seconds, and mean, percentiles and max in milliseconds."""
+		stats = {}
+		for name, durations in self.samples.items():
+			durations_ms = np.array(durations) * 1000
+			stats[name] = {
+				'count': len(durations),
+				'total_s': float(durations_ms.sum() / 1000),
+				'mean_ms': float(durations_ms.mean()),
+				**{
+					'p{}_ms'.format(p): float(value)
+					for p, value in zip(self.PERCENTILES, np.percentile(durations_ms, self.PERCENTILES))
+				},
+				'max_ms': float(durations_ms.max()),
+			}
+		return stats
+
+	def print_summary(self):
+		stats = self.summary()
+		columns = ['mean_ms', *('p{}_ms'.format(p) for p in self.PERCENTILES), 'max_ms']
+		print('{:<16} {:>7} {}'.format('stage', 'count', ' '.join('{:>9}'.format(c) for c in columns)))
+		for name, stage_stats in stats.items():
+			print('{:<16} {:>7} {}'.format(
+				name, stage_stats['count'], ' '.join('{:9.2f}'.format(stage_stats[c]) for c in columns)
+			))
+
+	def dump(self, path):
+		"""Write the summary as CSV if path ends in .csv, otherwise as JSON."""
+		stats = self.summary()
+		with open(path, 'w', newline='') as dump_file:
+			if str(path).endswith('.csv'):
+				fields = ['stage', 'count', 'total_s', 'mean_ms', *('p{}_ms'.format(p) for p in self.PERCENTILES), 'max_ms']
+				writer = csv.DictWriter(dump_file, fieldnames=fields)
+				writer.writeheader()
+				for name, stage_stats in stats.items():
+					writer.writerow({'stage': name, **stage_stats})
+			else:
+				json.dump(stats, dump_file, indent=2)
+
+
+class _Stage:
+	__slots__ = ('profiler', 'name', 'start')
+
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.profiler.record(self.name, time.perf_counter() - self.start)
@@ -0,0 +1,392 @@
+import asyncio
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+import cv2
+
+from .events import event_dict
+from .main import PianoVision
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# PianoVision options a job may set
+JOB_OPTIONS = {
+	'correct_rotation', 'reuse_buffers', 'motion_gating', 'incremental_diff', 'processing_scale', 'calibration_cache', 'skin_lut',
+	'rolling_reference', 'hand_tracking',
+}
+
+# Set in each worker process by attach_messages
+messages = None
+
+
+def attach_messages(queue):
+	global messages
+	cv2.setNumThreads(1)
+	messages = queue
+
+
+def transcribe_job(job_id, video_file, ref_frame_file, options):
+	"""Worker: transcribe a video headless, sending each note event back as it is found, then the
+	number of frames processed, or the error if it fails. Everything goes through the one queue, so it
+	arrives in order."""
+	messages.put((job_id, RUNNING, None))
+	try:
+		piano_vision = PianoVision(Path(video_file).stem, headless=True, **options)
+		piano_vision.video_file = str(video_file)
+		piano_vision.ref_frame_file = ref_frame_file
+		for event in piano_vision.note_events():
+			messages.put((job_id, 'event', event_dict(event)))
+	except Exception as e:
+		messages.put((job_id, FAILED, repr(e)))
+	else:
+		messages.put((job_id, DONE, piano_vision.end_position[0]))
+
+
+class Job:
+	def __init__(self, job_id, video_file, ref_frame_file=None, options=None, upload=False):
+		self.id = job_id
+		self.video_file = video_file
+		self.ref_frame_file = ref_frame_file
+		self.options = options or {}
+		self.upload = upload  # the video was uploaded, so is deleted once done
+
+		self.status = QUEUED
+		self.error = None
+		self.events = []
+		self.frames = None
+		self.submitted = time.time()
+		self.started = None
+		self.finished = None
+		self.changed = asyncio.Event()  # replaced by a fresh event on every change, after being set
+
+	def notify(self):
+		self.changed.set()
+		self.changed = asyncio.Event()
+
+	@property
+	def done(self):
+		return self.status in (DONE, FAILED)
+
+	def to_dict(self):
+		elapsed = (self.finished or time.time()) - self.started if self.started else None
+		return {
+			'id': self.id,
+			'video': str(self.video_file),
+			'status': self.status,
+			'error': self.error,
+			'events': len(self.events),
+			'frames': self.frames,
+			'submitted': self.submitted,
+			'started': self.started,
+			'finished': self.finished,
+			'elapsed_s': elapsed,
+			'fps': self.frames / elapsed if self.frames and elapsed else None,
+		}
+
+
+class TranscriptionService:
+	"""A small HTTP service that transcribes videos on a pool of worker processes, so that many
+	transcriptions can be driven from one long-lived process. Only the standard library is used, and
+	the HTTP handling is just enough for local clients such as curl:
+
+	POST /jobs                  JSON {"video": path, "reference_frame": path, "options": {...}} or
+	                            {"name": video in ./data}, or the video file itself as the body
+	GET  /jobs                  status of every job
+	GET  /jobs/<id>             status of one job
+	GET  /jobs/<id>/events      the job's note events as JSON lines, streamed as they are found
+	DELETE /jobs/<id>           forget a finished job
+	GET  /stats                 queue length and throughput
+
+	At most max_queued jobs may be waiting or running at once; more are refused with 503. Only the last
+	keep_finished finished jobs are kept, with their events, so that a long-lived service doesn't grow
+	without bound; the throughput statistics still count every job."""
+	MAX_QUEUED = 64
+	KEEP_FINISHED = 100
+	UPLOAD_CHUNK = 1 << 20
+	MAX_HEADER_LINES = 100
+
+	def __init__(self, workers=None, max_queued=MAX_QUEUED, upload_dir='cache/uploads', keep_finished=KEEP_FINISHED):
+		self.workers = workers or os.cpu_count()
+		self.max_queued = max_queued
+		self.upload_dir = Path(upload_dir)
+		self.keep_finished = keep_finished
+		self.jobs = {}
+		self.finished_ids = collections.deque()  # ids of finished jobs, oldest first
+		self.job_ids = itertools.count(1)
+		self.start_time = time.time()
+		# totals over every finished job, including those no longer kept
+		self.jobs_done = 0
+		self.jobs_failed = 0
+		self.frames_done = 0
+		self.events_done = 0
+		self.busy_time = 0.0
+
+		self.messages = multiprocessing.Queue()
+		self.executor = self.new_executor()
+		self.loop = None
+		self.forwarder = None
+
+	async def serve(self, host='127.0.0.1', port=8000):
+		self.loop = asyncio.get_running_loop()
+		self.forwarder = threading.Thread(target=self.forward_messages, name='TranscriptionService-messages', daemon=True)
+		self.forwarder.start()
+		server = await asyncio.start_server(self.handle_connection, host, port)
+		print('serving on http://{}:{} with {} workers'.format(host, port, self.workers))
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			self.close()
+
+	def new_executor(self):
+		return ProcessPoolExecutor(self.workers, initializer=attach_messages, initargs=(self.messages,))
+
+	def close(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
+		self.messages.put(None)
+
+	def forward_messages(self):
+		"""Thread: pass messages from the workers to their jobs on the event loop."""
+		for message in iter(self.messages.get, None):
+			self.loop.call_soon_threadsafe(self.handle_message, *message)
+
+	def handle_message(self, job_id, kind, payload):
+		job = self.jobs.get(job_id)
+		if job is None or job.done:
+			# Already failed, as when its worker process died, and perhaps since forgotten
+			return
+		if kind == RUNNING:
+			job.status = RUNNING
+			job.started = time.time()
+		elif kind == DONE:
+			job.frames = payload
+			self.finish(job, DONE)
+		elif kind == FAILED:
+			job.error = payload
+			self.finish(job, FAILED)
+		else:
+			job.events.append(payload)
+		job.notify()
+
+	# Jobs
+
+	def submit(self, job):
+		self.jobs[job.id] = job
+		executor = self.executor
+		try:
+			future = executor.submit(transcribe_job, job.id, job.video_file, job.ref_frame_file, job.options)
+		except BrokenProcessPool:
+			executor = self.restart_workers(executor)
+			future = executor.submit(transcribe_job, job.id, job.video_file, job.ref_frame_file, job.options)
+		# Errors in transcription come back as messages, so this only catches the worker itself failing
+		asyncio.wrap_future(future).add_done_callback(lambda f: self.worker_failed(job, executor, f.exception()) if f.exception() else None)
+		return job
+
+	def worker_failed(self, job, executor, exception):
+		self.failed(job, exception)
+		if isinstance(exception, BrokenProcessPool):
+			self.restart_workers(executor)
+
+	def restart_workers(self, broken):
+		"""Replace the pool after one of its workers died, which breaks the whole pool: the jobs that were
+		in it fail, but later jobs go to the new pool."""
+		if self.executor is broken:
+			broken.shutdown(wait=False)
+			self.executor = self.new_executor()
+		return self.executor
+
+	def failed(self, job, exception):
+		if job.done:
+			return
+		job.error = repr(exception)
+		self.finish(job, FAILED)
+		job.notify()
+
+	def finish(self, job, status):
+		job.status = status
+		job.started = job.started or job.submitted
+		job.finished = time.time()
+		if job.upload:
+			Path(job.video_file).unlink(missing_ok=True)
+		if status == DONE:
+			self.jobs_done += 1
+			self.frames_done += job.frames
+			self.events_done += len(job.events)
+			self.busy_time += job.finished - job.started
+		else:
+			self.jobs_failed += 1
+
+		self.finished_ids.append(job.id)
+		while len(self.finished_ids) > self.keep_finished:
+			self.jobs.pop(self.finished_ids.popleft(), None)
+
+	def forget(self, job):
+		"""Drop a finished job and its events."""
+		del self.jobs[job.id]
+		self.finished_ids.remove(job.id)
+
+	def active_jobs(self):
+		return sum(not job.done for job in self.jobs.values())
+
+	def stats(self):
+		uptime = time.time() - self.start_time
+		return {
+			'workers': self.workers,
+			'queued': sum(job.status == QUEUED for job in self.jobs.values()),
+			'running': sum(job.status == RUNNING for job in self.jobs.values()),
+			'done': self.jobs_done,
+			'failed': self.jobs_failed,
+			'kept': len(self.finished_ids),
+			'frames': self.frames_done,
+			'events': self.events_done,
+			'uptime_s': uptime,
+			'jobs_per_minute': self.jobs_done * 60 / uptime if uptime else 0.0,
+			'fps': self.frames_done / uptime if uptime else 0.0,  # over the whole uptime, across all workers
+			'fps_per_job': self.frames_done / self.busy_time if self.busy_time else 0.0,  # while running
+		}
+
+	# HTTP
+
+	async def handle_connection(self, reader, writer):
+		try:
+			request_line = (await reader.readline()).decode('latin-1').split()
+			if len(request_line) != 3:
+				return
+			method, target, _ = request_line
+			headers = {}
+			for _ in range(self.MAX_HEADER_LINES):
+				line = (await reader.readline()).decode('latin-1').strip()
+				if not line:
+					break
+				name, _, value = line.partition(':')
+				headers[name.strip().lower()] = value.strip()
+
+			url = urlsplit(target)
+			parts = [part for part in url.path.split('/') if part]
+			status, body = await self.route(method, parts, parse_qs(url.query), headers, reader, writer)
+			if body is not None:
+				await self.respond(writer, status, body)
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except Exception as e:
+			await self.respond(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': repr(e)})
+		finally:
+			writer.close()
+
+	async def route(self, method, parts, query, headers, reader, writer):
+		"""Returns (status, JSON body), or (None, None) if the response has already been written."""
+		if parts == ['jobs'] and method == 'POST':
+			return await self.create_job(query, headers, reader)
+		if parts == ['jobs'] and method == 'GET':
+			return HTTPStatus.OK, [job.to_dict() for job in self.jobs.values()]
+		if parts == ['stats'] and method == 'GET':
+			return HTTPStatus.OK, self.stats()
+		if len(parts) in (2, 3) and parts[0] == 'jobs' and method in ('GET', 'DELETE'):
+			job = self.jobs.get(int(parts[1])) if parts[1].isdigit() else None
+			if job is None:
+				return HTTPStatus.NOT_FOUND, {'error': 'no such job'}
+			if parts[2:] == [] and method == 'DELETE':
+				if not job.done:
+					return HTTPStatus.CONFLICT, {'error': 'job is still {}'.format(job.status)}
+				self.forget(job)
+				return HTTPStatus.OK, job.to_dict()
+			if parts[2:] == [] and method == 'GET':
+				return HTTPStatus.OK, job.to_dict()
+			if parts[2:] == ['events'] and method == 'GET':
+				await self.stream_events(job, writer)
+				return None, None
+		return HTTPStatus.NOT_FOUND, {'error': 'not found'}
+
+	async def create_job(self, query, headers, reader):
+		if self.active_jobs() >= self.max_queued:
+			return HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'queue is full'}
+		try:
+			video_file, ref_frame_file, options, upload = await self.read_job_request(query, headers, reader)
+		except ValueError as e:
+			# Malformed JSON, content length or option values
+			return HTTPStatus.BAD_REQUEST, {'error': str(e)}
+
+		unknown = set(options) - JOB_OPTIONS
+		if unknown:
+			if upload:
+				video_file.unlink()
+			return HTTPStatus.BAD_REQUEST, {'error': 'unknown options: {}'.format(', '.join(sorted(unknown)))}
+		# Only accepted jobs are numbered, so the ids run on without gaps
+		job = self.submit(Job(next(self.job_ids), video_file, ref_frame_file, options, upload))
+		return HTTPStatus.ACCEPTED, job.to_dict()
+
+	async def read_job_request(self, query, headers, reader):
+		"""The video, reference frame and options a job was requested with, and whether the video was
+		uploaded. Raises ValueError if the request is malformed."""
+		length = int(headers.get('content-length', 0))
+		if headers.get('content-type', '').startswith('application/json'):
+			request = json.loads(await reader.readexactly(length) or b'{}')
+			if not isinstance(request, dict) or not isinstance(request.get('options', {}), dict):
+				raise ValueError('expected a JSON object, with options as an object')
+			if 'name' in request:
+				video_file = Path('data/{}.mp4'.format(request['name']))
+				ref_frame_file = 'data/{}-f00.png'.format(request['name'])
+			else:
+				video_file = Path(request.get('video', ''))
+				ref_frame_file = request.get('reference_frame')
+			if not video_file.is_file():
+				raise ValueError('no video at {}'.format(video_file))
+			return video_file, ref_frame_file, request.get('options', {}), False
+
+		# The body is the video itself, with any options in the query string
+		options = {name: json.loads(values[-1]) for name, values in query.items()}
+		self.upload_dir.mkdir(parents=True, exist_ok=True)
+		upload_fd, video_file = tempfile.mkstemp(suffix='.mp4', dir=self.upload_dir)
+		video_file = Path(video_file)
+		try:
+			with open(upload_fd, 'wb') as upload_file:
+				remaining = length
+				while remaining:
+					chunk = await reader.readexactly(min(remaining, self.UPLOAD_CHUNK))
+					upload_file.write(chunk)
+					remaining -= len(chunk)
+		except BaseException:
+			video_file.unlink(missing_ok=True)
+			raise
+		return video_file, None, options, True
+
+	async def stream_events(self, job, writer):
+		"""Send the job's events as chunked JSON lines, from the first, as they arrive, finishing with a
+		line giving the job's final status."""
+		writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+		sent = 0
+		while True:
+			changed = job.changed
+			if sent < len(job.events):
+				lines = ''.join(json.dumps(event) + '\n' for event in job.events[sent:]).encode()
+				sent = len(job.events)
+				writer.write(b'%x\r\n%s\r\n' % (len(lines), lines))
+				await writer.drain()
+			if job.done:
+				break
+			await changed.wait()
+		line = (json.dumps(job.to_dict()) + '\n').encode()
+		writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(line), line))
+		await writer.drain()
+
+	@staticmethod
+	async def respond(writer, status, body):
+		content = (json.dumps(body) + '\n').encode()
+		writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+			status.value, status.phrase, len(content)
+		).encode() + content)
+		await writer.drain()
@@ -1,20 +1,99 @@
+import queue
+import threading
+
 import cv2
 
 
 class VideoReader:
-	def __init__(self, video_file):
+	def __init__(self, video_file, prefetch=0, start_frame=0):
 		self.video_file = video_file
+		self.prefetch = prefetch  # how many frames to decode ahead on a background thread, 0 to disable
+		self.start_frame = start_frame  # index of the first frame to read
+
+		# index and timestamp (ms) of the last frame returned by read_frame
+		self.frame_index = start_frame - 1
+		self.timestamp = None
+
+		self.frame_queue = None
+		self.decoder = None
+		self.stopped = threading.Event()
+		self.exhausted = False
+		self.container_frame_count = None
+		self.container_fps = None
 
 	def __enter__(self):
 		self.video = cv2.VideoCapture(self.video_file)
+		if self.start_frame:
+			self.video.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+			# Some codecs can only seek to a nearby keyframe, which would silently misplace every frame index
+			position = int(self.video.get(cv2.CAP_PROP_POS_FRAMES))
+			if position != self.start_frame:
+				self.video.release()
+				raise IOError('could not seek {} to frame {} (reached frame {})'.format(self.video_file, self.start_frame, position))
+		# Read once before the decoder thread starts, as the capture isn't safe to use from two threads
+		self.container_frame_count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+		self.container_fps = self.video.get(cv2.CAP_PROP_FPS)
+		if self.prefetch > 0:
+			self.frame_queue = queue.Queue(maxsize=self.prefetch)
+			self.stopped.clear()
+			self.decoder = threading.Thread(target=self.decode_frames, name='VideoReader-decoder', daemon=True)
+			self.decoder.start()
 		return self
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
+		if self.decoder is not None:
+			self.stopped.set()
+			# Unblock the decoder if it is waiting on a full queue
+			while self.decoder.is_alive():
+				try:
+					self.frame_queue.get_nowait()
+				except queue.Empty:
+					pass
+				self.decoder.join(timeout=0.05)
+			self.decoder = None
 		self.video.release()
 
+	@property
+	def frame_count(self):
+		"""Number of frames in the video, as reported by the container (may be approximate)."""
+		return self.container_frame_count
+
+	@property
+	def fps(self):
+		"""Frame rate reported by the container, or 30 if it doesn't say."""
+		return self.container_fps or 30
+
+	def decode_frames(self):
+		"""Decoder thread: fills the queue with (index, timestamp, frame), then None once the video ends."""
+		index = self.start_frame
+		while not self.stopped.is_set():
+			ret, frame = self.video.read()
+			item = (index, self.video.get(cv2.CAP_PROP_POS_MSEC), frame) if ret else None
+			while not self.stopped.is_set():
+				try:
+					self.frame_queue.put(item, timeout=0.1)
+					break
+				except queue.Full:
+					pass
+			if item is None:
+				return
+			index += 1
+
 	def read_frame(self):
-		ret, frame = self.video.read()
-		if ret:
-			return frame
-		else:
+		if self.frame_queue is None:
+			ret, frame = self.video.read()
+			if ret:
+				self.frame_index += 1
+				self.timestamp = self.video.get(cv2.CAP_PROP_POS_MSEC)
+				return frame
+			else:
+				return None
+
+		if self.exhausted:
+			return None
+		item = self.frame_queue.get()
+		if item is None:
+			self.exhausted = True
 			return None
+		self.frame_index, self.timestamp, frame = item
+		return frame
@@ -1,15 +1,120 @@
-import sys
+import argparse
+from contextlib import ExitStack
+from pathlib import Path
+
+import cv2
+
+from piano_vision.calibration_cache import CalibrationCache
+from piano_vision.debug import FileSink, WindowSink
+from piano_vision.events import JsonlSink, MidiSink, SnapshotLogSink
+from piano_vision.live import CameraSource, ReplaySource
 from piano_vision.main import PianoVision
+from piano_vision.processors import PressedKeyDetector
+from piano_vision.parallel import ParallelPianoVision
 
 
 VIDEO_NAME = 'canon_in_d'
 
 
+def capture_device(value):
+	"""Camera number if numeric, otherwise a path or URL for cv2.VideoCapture."""
+	return int(value) if value.isdigit() else value
+
+
 if __name__ == '__main__':
-	video_name = VIDEO_NAME
+	parser = argparse.ArgumentParser(description='Transcribe a piano video from ./data.')
+	parser.add_argument('video_name', nargs='?', default=VIDEO_NAME, help='name of the video in ./data (without .mp4)')
+	parser.add_argument('--headless', action='store_true', help='run without windows or key polling, as fast as possible')
+	parser.add_argument('--prefetch', type=int, default=0, metavar='N', help='decode up to N frames ahead on a background thread')
+	parser.add_argument('--correct-rotation', action='store_true', help='straighten a tilted keyboard as part of rectification')
+	parser.add_argument('--reuse-buffers', action='store_true', help='reuse preallocated per-frame buffers instead of allocating new ones')
+	parser.add_argument('--processes', type=int, metavar='N', help='split the video across N worker processes (implies --headless)')
+	parser.add_argument('--motion-gating', action='store_true', help='skip detection on frames where the keyboard has not changed')
+	parser.add_argument('--incremental-diff', action='store_true', help='only recompute the parts of the pressed key diff that have changed')
+	parser.add_argument('--scale', type=float, default=1.0, help='find hands and pressed keys at this fraction of the keyboard resolution')
+	parser.add_argument('--skin-lut', action='store_true', help='classify skin with a lookup table of every BGR colour instead of converting to HSV')
+	parser.add_argument('--hand-tracking', action='store_true', help='look for hands only around where they are expected, searching the whole frame when that fails')
+	parser.add_argument('--rolling-reference', type=float, nargs='?', const=PressedKeyDetector.REFERENCE_UPDATE_RATE, default=0.0, metavar='RATE', help='keep the reference frame up to date with a running average of the keys at rest, weighting each frame by RATE')
+	parser.add_argument('--profile', metavar='PATH', help='time each stage of every frame and write latency percentiles to PATH (.json or .csv)')
+	parser.add_argument('--events', metavar='PATH', help='stream note on/off events to PATH as JSON lines (implies --headless)')
+	parser.add_argument('--midi', metavar='PATH', help='stream note on/off events to PATH as a MIDI file (implies --headless)')
+	parser.add_argument('--full-log', action='store_true', help='with --events, --midi, --live or --replay, log every snapshot rather than the first 20')
+	parser.add_argument('--live', type=capture_device, metavar='DEVICE', help='transcribe live from a camera number or stream URL, dropping frames to keep up')
+	parser.add_argument('--replay', type=float, metavar='FPS', help='transcribe live from the video replayed in real time at FPS, as if from a camera')
+	parser.add_argument('--latency-budget', type=float, default=PianoVision.LIVE_LATENCY_BUDGET, metavar='MS', help='with --live or --replay, drop frames older than MS milliseconds')
+	parser.add_argument('--frame-cache', action='store_true', help='read rectified frames from a memory-mapped cache, rectifying the video into it first if needed')
+	parser.add_argument('--debug', metavar='windows|DIR', help='show the processors\' debug overlays in windows, or write them to DIR')
+	parser.add_argument('--debug-interval', type=int, default=1, metavar='N', help='with --debug DIR, only write every Nth overlay of each kind')
+	parser.add_argument('--no-calibration-cache', action='store_true', help='neither read nor write cached calibrations')
+	parser.add_argument('--recalibrate', action='store_true', help='ignore any cached calibration and replace it')
+	parser.add_argument('--clear-calibration-cache', action='store_true', help='delete all cached calibrations first')
+	args = parser.parse_args()
+	live = args.live is not None or args.replay
+	streaming = args.events or args.midi
+	if streaming and args.processes:
+		parser.error('--events and --midi cannot be combined with --processes')
+	if live and (args.processes or args.frame_cache):
+		parser.error('--live and --replay cannot be combined with --processes or --frame-cache')
+
+	if (args.motion_gating or args.incremental_diff or args.rolling_reference or args.hand_tracking) and args.processes:
+		parser.error('--motion-gating, --incremental-diff, --rolling-reference and --hand-tracking cannot be combined with --processes')
+
+	if args.clear_calibration_cache:
+		CalibrationCache().invalidate()
+
+	if args.debug == 'windows':
+		debug = WindowSink()
+	elif args.debug:
+		debug = FileSink(args.debug, args.debug_interval)
+	else:
+		debug = None
+
+	options = dict(
+		prefetch=args.prefetch,
+		correct_rotation=args.correct_rotation,
+		reuse_buffers=args.reuse_buffers,
+		calibration_cache=not args.no_calibration_cache,
+		recalibrate=args.recalibrate,
+		motion_gating=args.motion_gating,
+		incremental_diff=args.incremental_diff,
+		processing_scale=args.scale,
+		skin_lut=args.skin_lut,
+		rolling_reference=args.rolling_reference,
+		hand_tracking=args.hand_tracking,
+		profile=bool(args.profile),
+		frame_cache=args.frame_cache,
+		debug=debug,
+	)
+
+	if args.processes:
+		piano_vision = ParallelPianoVision(args.video_name, processes=args.processes, **options)
+	elif args.live is not None:
+		piano_vision = PianoVision(args.video_name, headless=args.headless, output_name='live', **options)
+	else:
+		piano_vision = PianoVision(args.video_name, headless=args.headless or (streaming and not live), **options)
 
-	if len(sys.argv) >= 2:
-		video_name = sys.argv[1]
+	if streaming or live:
+		with ExitStack() as sinks:
+			log = sinks.enter_context(SnapshotLogSink(
+				'output/{}.log'.format(piano_vision.output_name), PianoVision.SNAPSHOT_INTERVAL,
+				limit=None if args.full_log else PianoVision.NUM_SNAPSHOTS
+			))
+			sink_list = [log]
+			if args.events:
+				sink_list.append(sinks.enter_context(JsonlSink(args.events)))
+			if args.midi:
+				sink_list.append(sinks.enter_context(MidiSink(args.midi)))
 
-	piano_vision = PianoVision(video_name)
-	piano_vision.main_loop()
+			if args.live is not None:
+				piano_vision.live_loop(CameraSource(args.live), args.latency_budget, sinks=sink_list)
+			elif live:
+				reference_frame = cv2.imread(piano_vision.ref_frame_file) if Path(piano_vision.ref_frame_file).exists() else None
+				piano_vision.live_loop(
+					ReplaySource(piano_vision.video_file, args.replay), args.latency_budget, reference_frame, sinks=sink_list
+				)
+			else:
+				print('{} note events'.format(piano_vision.transcribe(*sink_list)))
+	else:
+		piano_vision.main_loop()
+	if args.profile:
+		piano_vision.profiler.dump(args.profile)
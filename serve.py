@@ -0,0 +1,20 @@
+import argparse
+import asyncio
+
+from piano_vision.service import TranscriptionService
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve transcriptions over HTTP from a pool of worker processes.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('--workers', type=int, metavar='N', help='transcribe up to N videos at once (default: one per CPU)')
+	parser.add_argument('--max-queued', type=int, default=TranscriptionService.MAX_QUEUED, metavar='N', help='refuse new jobs while N are waiting or running')
+	parser.add_argument('--keep-finished', type=int, default=TranscriptionService.KEEP_FINISHED, metavar='N', help='forget all but the last N finished jobs')
+	args = parser.parse_args()
+
+	service = TranscriptionService(args.workers, args.max_queued, keep_finished=args.keep_finished)
+	try:
+		asyncio.run(service.serve(args.host, args.port))
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,148 @@
+"""Evaluates every combination of a grid of detector settings on one video, across a process pool.
+
+Usage: python sweep.py video_name --param NAME=VALUES [--param NAME=VALUES ...] [--processes N] [--csv PATH]
+e.g. python sweep.py call_me_maybe --param 'PressedKeyDetector.STICKINESS=[1, 2, 3]' \\
+	--param 'HandFinder.SKIN_LOWER=[[0, 48, 80], [0, 30, 60]]'
+
+NAME is a class constant of HandFinder or PressedKeyDetector and VALUES a JSON list of values to try.
+The video is decoded and rectified once, into shared memory that every worker reads from, and each
+setting's log is scored in memory against ./ground_truths/<video_name>.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from calc_accuracy import score_lines
+from piano_vision.events import snapshot_line
+from piano_vision.main import PianoVision
+from piano_vision.processors import HandFinder, PressedKeyDetector
+from piano_vision.video_reader import VideoReader
+
+TUNABLE_CLASSES = {cls.__name__: cls for cls in (HandFinder, PressedKeyDetector)}
+
+# Set in each worker by attach_frames
+pipeline = None
+block = None
+keyboards = None
+
+
+def parse_param(text):
+	name, values = text.split('=', 1)
+	class_name, attribute = name.split('.')
+	if class_name not in TUNABLE_CLASSES or not hasattr(TUNABLE_CLASSES[class_name], attribute):
+		raise argparse.ArgumentTypeError('{} is not a HandFinder or PressedKeyDetector setting'.format(name))
+	return name, json.loads(values)
+
+
+def with_settings(cls, settings):
+	"""Subclass of cls with the given class constants overridden."""
+	overrides = {
+		attribute: np.array(value, dtype=getattr(cls, attribute).dtype) if isinstance(getattr(cls, attribute), np.ndarray) else value
+		for attribute, value in settings.items()
+	}
+	return type(cls.__name__, (cls,), overrides)
+
+
+def rectify_video(video_name, frame_count):
+	"""Calibrate on the video's reference frame, then rectify its first frame_count frames into a
+	shared memory block. Returns the calibrated PianoVision, the block and the frames' shape."""
+	calibrated = PianoVision(video_name, headless=True)
+	calibrated.calibrate()
+	keyboards = []
+	with VideoReader(calibrated.video_file) as video_reader:
+		frame = video_reader.read_frame()
+		while frame is not None and len(keyboards) < frame_count:
+			keyboards.append(calibrated.bounder.get_bounded_section(frame, calibrated.bounds, calibrated.rotation).copy())
+			frame = video_reader.read_frame()
+
+	shape = (len(keyboards), *keyboards[0].shape)
+	block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+	np.stack(keyboards, out=np.ndarray(shape, np.uint8, buffer=block.buf))
+	return calibrated, block, shape
+
+
+def attach_frames(calibrated, block_name, shape):
+	"""Worker initializer: keep the calibrated pipeline and a view of the shared rectified frames."""
+	global pipeline, block, keyboards
+	cv2.setNumThreads(1)
+	pipeline = calibrated
+	block = shared_memory.SharedMemory(name=block_name)
+	keyboards = np.ndarray(shape, np.uint8, buffer=block.buf)
+
+
+def evaluate(settings, truths):
+	"""Transcribe the shared frames with the given settings, returning their scores."""
+	by_class = {}
+	for name, value in settings.items():
+		class_name, attribute = name.split('.')
+		by_class.setdefault(class_name, {})[attribute] = value
+
+	pipeline.hand_finder = with_settings(HandFinder, by_class.get('HandFinder', {}))(scale=pipeline.processing_scale)
+	pipeline.pressed_key_detector = detector = with_settings(PressedKeyDetector, by_class.get('PressedKeyDetector', {}))(
+		pipeline.reference_frame, pipeline.keys_manager, scale=pipeline.processing_scale
+	)
+
+	lines = []
+	for frame_index, keyboard in enumerate(keyboards):
+		pressed_keys = pipeline.detect(keyboard)[2]
+		detector.process_sticky_pressed_changes(pressed_keys)
+		if frame_index % PianoVision.SNAPSHOT_INTERVAL == 0:
+			lines.append(snapshot_line(frame_index // PianoVision.SNAPSHOT_INTERVAL, detector.currently_pressed))
+	# A video that ends early is missing its last snapshots, which count as nothing pressed
+	lines += ['{}: []\n'.format(i) for i in range(len(lines), len(truths))]
+	return score_lines(truths, lines)
+
+
+def sweep(video_name, grid, processes=None):
+	"""Scores every combination of the grid ({name: [values]}), best F1 (then precision) first."""
+	with open('ground_truths/{}'.format(video_name)) as ground_truth_file:
+		truths = ground_truth_file.readlines()
+	calibrated, block, shape = rectify_video(video_name, len(truths) * PianoVision.SNAPSHOT_INTERVAL)
+
+	names = list(grid)
+	combinations = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+	try:
+		with ProcessPoolExecutor(processes or os.cpu_count(), initializer=attach_frames, initargs=(calibrated, block.name, shape)) as executor:
+			scores = list(executor.map(evaluate, combinations, itertools.repeat(truths)))
+	finally:
+		block.close()
+		block.unlink()
+
+	results = [{**settings, **stats} for settings, stats in zip(combinations, scores)]
+	return sorted(results, key=lambda result: (result['f1'], result['precision']), reverse=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('video_name')
+	parser.add_argument('--param', type=parse_param, action='append', required=True, metavar='NAME=VALUES')
+	parser.add_argument('--processes', type=int, metavar='N')
+	parser.add_argument('--csv', metavar='PATH', help='also write the ranked results to PATH')
+	args = parser.parse_args()
+
+	grid = dict(args.param)
+	results = sweep(args.video_name, grid, args.processes)
+
+	columns = [*grid, 'precision', 'recall', 'f1']
+	rows = [[json.dumps(result[column]) if column in grid else '{:.3f}'.format(result[column]) for column in columns] for result in results]
+	widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+	print('rank  ' + '  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+	for rank, row in enumerate(rows, start=1):
+		print('{:<4}  '.format(rank) + '  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+	if args.csv:
+		with open(args.csv, 'w', newline='') as csv_file:
+			writer = csv.writer(csv_file)
+			writer.writerow(['rank', *columns])
+			writer.writerows([rank, *row] for rank, row in enumerate(rows, start=1))
+
+
+if __name__ == '__main__':
+	main()